@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""Benchmark các đường nóng của FaceRecognitionService.
+
+Đo so khớp gallery tổng hợp (100 → 100k encoding), load_known_faces (lần đầu và
+từ cache), register_face / delete_registered_face trên bộ ảnh mẫu, và phát lại
+video ghi sẵn qua vòng lặp recognize_face_from_camera. Kết quả (throughput, độ
+trễ p50/p95/p99, RSS) được ghi ra một file JSON để so sánh giữa các lần chạy.
+
+Không có --sample_images thì script tự vẽ một bộ khuôn mặt tổng hợp (mục
+"samples" trong report ghi "synthetic"). Ảnh vẽ vẫn đo được chi phí decode,
+detect, cache và luồng đăng ký, nhưng dlib có thể không nhận ra chúng là khuôn
+mặt: khi đó loaded_faces = 0 và register chỉ đo đường từ chối ("outcomes").
+Số liệu encode/đăng ký đại diện cần ảnh chụp thật qua --sample_images.
+
+Ví dụ:
+    python benchmark_face_recognition.py --sample_images samples --video gate.mp4 \\
+        --models hog cnn --frame_scales 0.25 0.5 --output report.json
+"""
+import sys
+import os
+import argparse
+import json
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from face_recognition_service import (
+    FaceRecognitionService, VideoFileSource, IMAGE_EXTENSIONS, ENCODING_SIZE, atomic_write_json
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def peak_rss_mb():
+    """RSS lớn nhất của process (MB), None nếu hệ điều hành không hỗ trợ"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux trả về KB, macOS trả về byte
+    return round(peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1)
+
+def current_rss_mb():
+    """RSS hiện tại (MB) đọc từ /proc, None nếu không có"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0), 1)
+    except Exception:
+        return None
+
+def summarize(durations_ms, items=None):
+    """Thống kê độ trễ (ms) và throughput (items/giây) của một dãy phép đo"""
+    data = np.asarray(durations_ms, dtype=np.float64)
+    if len(data) == 0:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(data, [50, 95, 99])
+    total_seconds = data.sum() / 1000.0
+    return {
+        "count": int(len(data)),
+        "mean_ms": round(float(data.mean()), 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(data.max()), 3),
+        "throughput_per_s": round((items or len(data)) / total_seconds, 2) if total_seconds > 0 else None
+    }
+
+def random_encodings(rng, count):
+    """Encoding tổng hợp có phân bố gần với encoding dlib (chuẩn ~0.4 quanh một tâm chung)"""
+    center = rng.normal(0.0, 0.08, ENCODING_SIZE)
+    encodings = center + rng.normal(0.0, 0.035, (count, ENCODING_SIZE))
+    return encodings.astype(np.float32)
+
+def generate_sample_images(folder, count, rng, size=400):
+    """Vẽ count ảnh khuôn mặt tổng hợp (mỗi ảnh một "người"), trả về danh sách đường dẫn"""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(count):
+        background = rng.integers(90, 200, 3)
+        image = np.clip(rng.normal(background, 12, (size, size, 3)), 0, 255).astype(np.uint8)
+        cx, cy = size // 2 + int(rng.integers(-15, 16)), size // 2 + int(rng.integers(-10, 11))
+        face_w, face_h = int(rng.integers(95, 120)), int(rng.integers(125, 150))
+        skin = tuple(int(v) for v in rng.integers([90, 120, 160], [150, 180, 230]))
+        hair = tuple(int(v) for v in rng.integers(10, 70, 3))
+        cv2.ellipse(image, (cx, cy - 25), (face_w + 8, face_h - 10), 0, 180, 360, hair, -1)
+        cv2.ellipse(image, (cx, cy), (face_w, face_h), 0, 0, 360, skin, -1)
+        eye_dx, eye_y = int(face_w * 0.42), cy - int(face_h * 0.2)
+        for side in (-1, 1):
+            ex = cx + side * eye_dx
+            cv2.line(image, (ex - 22, eye_y - 24), (ex + 22, eye_y - 26 + side * 2), hair, 6)
+            cv2.ellipse(image, (ex, eye_y), (20, 10), 0, 0, 360, (245, 245, 245), -1)
+            cv2.circle(image, (ex + int(rng.integers(-3, 4)), eye_y), 7, hair, -1)
+        shadow = tuple(max(0, v - 45) for v in skin)
+        cv2.line(image, (cx, eye_y + 10), (cx - 8, cy + 30), shadow, 4)
+        cv2.ellipse(image, (cx, cy + 32), (16, 6), 0, 0, 360, shadow, -1)
+        cv2.ellipse(image, (cx, cy + int(face_h * 0.5)), (int(rng.integers(26, 40)), 9), 0, 0, 360, (70, 70, 150), -1)
+        image = cv2.GaussianBlur(image, (5, 5), 0)
+        path = os.path.join(folder, f"S{i:04d}_Synthetic.jpg")
+        cv2.imwrite(path, image)
+        paths.append(path)
+    return paths
+
+def list_sample_images(folder):
+    if not folder:
+        return []
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+            if f.lower().endswith(IMAGE_EXTENSIONS)]
+
+class BenchmarkWorkspace:
+    """Thư mục tạm chứa config.json, faces và cache riêng cho mỗi kịch bản"""
+    def __init__(self, base_config, root):
+        self.base_config = base_config
+        self.root = root
+
+    def create_service(self, name, overrides=None, faces=None):
+        folder = os.path.join(self.root, name)
+        os.makedirs(folder, exist_ok=True)
+        config = json.loads(json.dumps(self.base_config))
+        config.update({
+            "faces_folder": os.path.join(folder, "faces"),
+            "encoding_cache_folder": os.path.join(folder, "faces", ".encodings"),
+            "attendance_images_folder": os.path.join(folder, "attendance_images"),
+            "logging": {"enable_logging": False, "metrics_file": None}
+        })
+        for section, values in (overrides or {}).items():
+            if isinstance(values, dict):
+                config.setdefault(section, {}).update(values)
+            else:
+                config[section] = values
+        os.makedirs(config["faces_folder"], exist_ok=True)
+        for filename, source in (faces or {}).items():
+            shutil.copyfile(source, os.path.join(config["faces_folder"], filename))
+        config_path = os.path.join(folder, "config.json")
+        atomic_write_json(config_path, config)
+        return FaceRecognitionService(config_path)
+
+def bench_matching(workspace, sizes, queries, index, rng):
+    """So khớp một khuôn mặt/frame với gallery tổng hợp (đường nóng của vòng camera)"""
+    results = []
+    # ivf_min_gallery_size = 0 để index IVF được dựng cả với các gallery nhỏ trong sizes
+    service = workspace.create_service("matching-" + index, {"matching": {"index": index, "ivf_min_gallery_size": 0}})
+    try:
+        for size in sizes:
+            service.reset_gallery()
+            encodings = random_encodings(rng, size)
+            for row, encoding in enumerate(encodings):
+                service.gallery.add(f"E{row}_Synthetic.jpg", f"E{row}", "Synthetic", encoding)
+            build_start = time.perf_counter()
+            service.build_search_index()
+            build_ms = (time.perf_counter() - build_start) * 1000.0
+            searched = service.gallery.templates if service.gallery.templates is not None else service.gallery
+            index_attached = searched.index is not None
+
+            # Một nửa truy vấn là người đã đăng ký (nhiễu nhỏ), nửa còn lại là người lạ
+            targets = rng.integers(0, size, queries)
+            probes = encodings[targets] + rng.normal(0.0, 0.01, (queries, ENCODING_SIZE)).astype(np.float32)
+            probes[queries // 2:] = random_encodings(rng, queries - queries // 2)
+
+            durations = []
+            hits = 0
+            for i, probe in enumerate(probes):
+                start = time.perf_counter()
+                face = service.identify_faces([(0, 1, 1, 0)], [probe])[0]
+                durations.append((time.perf_counter() - start) * 1000.0)
+                if i < queries // 2 and face["employee_id"] == f"E{targets[i]}":
+                    hits += 1
+
+            result = dict(summarize(durations), gallery_size=size, index=index,
+                          index_attached=index_attached, index_build_ms=round(build_ms, 3),
+                          known_hit_rate=round(hits / max(1, queries // 2), 4),
+                          rss_mb=current_rss_mb())
+            print(f"matching index={index} (attached={index_attached}) size={size}: p50={result['p50_ms']}ms p99={result['p99_ms']}ms", file=sys.stderr)
+            results.append(result)
+    finally:
+        service.close()
+    return results
+
+def bench_gallery_load(workspace, sample_images, gallery_size):
+    """load_known_faces khi chưa có cache (encode toàn bộ) và khi cache còn hiệu lực"""
+    faces = {}
+    for i in range(gallery_size):
+        source = sample_images[i % len(sample_images)]
+        faces[f"B{i:05d}_Sample{os.path.splitext(source)[1]}"] = source
+
+    start = time.perf_counter()
+    service = workspace.create_service("gallery-load", faces=faces)
+    cold_ms = (time.perf_counter() - start) * 1000.0
+    loaded = len(service.gallery)
+    service.close()
+
+    warm = []
+    for _ in range(3):
+        start = time.perf_counter()
+        service = workspace.create_service("gallery-load")
+        warm.append((time.perf_counter() - start) * 1000.0)
+        service.close()
+
+    result = {
+        "images": gallery_size,
+        "loaded_faces": loaded,
+        "cold_ms": round(cold_ms, 3),
+        "cold_images_per_s": round(gallery_size / (cold_ms / 1000.0), 2) if cold_ms > 0 else None,
+        "warm": summarize(warm, gallery_size)
+    }
+    print(f"load_known_faces {gallery_size} images: cold={result['cold_ms']}ms warm p50={result['warm']['p50_ms']}ms", file=sys.stderr)
+    return result
+
+def bench_register_delete(workspace, sample_images, count):
+    """register_face rồi delete_registered_face cho từng ảnh mẫu"""
+    service = workspace.create_service("register")
+    register_ms, delete_ms = [], []
+    outcomes = {}
+    try:
+        for i in range(count):
+            employee_id = f"R{i:05d}"
+            start = time.perf_counter()
+            result = service.register_face(employee_id, "Benchmark", sample_images[i % len(sample_images)])
+            register_ms.append((time.perf_counter() - start) * 1000.0)
+            message = "success" if result.get("success") else result.get("message", "failed")
+            outcomes[message] = outcomes.get(message, 0) + 1
+            if result.get("success"):
+                start = time.perf_counter()
+                service.delete_registered_face(employee_id)
+                delete_ms.append((time.perf_counter() - start) * 1000.0)
+    finally:
+        service.close()
+    return {"register": summarize(register_ms), "delete": summarize(delete_ms), "outcomes": outcomes}
+
+def bench_video(workspace, video_path, model, frame_scale, face_images, realtime, timeout):
+    """Phát lại video qua vòng lặp camera (continuous) với model và frame_scale cho trước"""
+    faces = {os.path.basename(p): p for p in face_images}
+    name = f"video-{model}-{frame_scale}"
+    service = workspace.create_service(name, {
+        "performance": {"face_detection_model": model, "frame_scale": frame_scale},
+        # Phát lại trọn video kể cả đoạn không có khuôn mặt
+        "decision": {"idle_timeout": 0}
+    }, faces=faces)
+    try:
+        replay = VideoFileSource(video_path, realtime=realtime)
+        start = time.perf_counter()
+        result = service.recognize_face_from_camera(timeout=timeout, continuous=True, frame_source=replay)
+        elapsed = time.perf_counter() - start
+        snapshot = service.metrics.snapshot()
+    finally:
+        service.close()
+
+    counters = snapshot["counters"]
+    report = {
+        "video": os.path.basename(video_path),
+        "model": model,
+        "frame_scale": frame_scale,
+        "realtime": realtime,
+        "elapsed_s": round(elapsed, 3),
+        "frames_read": counters.get("frames_captured", 0),
+        "frames_processed": counters.get("frames_processed", 0),
+        "processed_fps": round(counters.get("frames_processed", 0) / elapsed, 2) if elapsed > 0 else None,
+        "recognized": sorted(r["employee_id"] for r in result.get("recognitions", [])) if result.get("success") else [],
+        "counters": counters,
+        "latency_ms": {k: v for k, v in snapshot["latency_ms"].items()
+                       if k in ("detection", "encoding", "matching", "tracking", "frame_capture", "time_to_match")},
+        "rss_mb": current_rss_mb()
+    }
+    print(f"video {report['video']} model={model} scale={frame_scale}: {report['processed_fps']} fps, "
+          f"recognized={report['recognized']}", file=sys.stderr)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark FaceRecognitionService')
+    parser.add_argument('--config', default='config.json', help='config.json gốc (faces/cache được thay bằng thư mục tạm)')
+    parser.add_argument('--output', default='benchmark_report.json', help='File JSON kết quả')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gallery_sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--queries', type=int, default=200, help='Số truy vấn so khớp cho mỗi kích thước gallery')
+    parser.add_argument('--indexes', nargs='+', default=['linear', 'ivf'], choices=['linear', 'ivf'])
+    parser.add_argument('--sample_images', help='Thư mục ảnh khuôn mặt mẫu (mỗi ảnh một người); bỏ trống để tự sinh ảnh tổng hợp')
+    parser.add_argument('--synthetic_samples', type=int, default=20, help='Số ảnh tổng hợp sinh ra khi không có --sample_images')
+    parser.add_argument('--load_gallery_size', type=int, default=50, help='Số ảnh cho benchmark load_known_faces')
+    parser.add_argument('--register_count', type=int, default=20)
+    parser.add_argument('--video', nargs='*', default=[], help='Video ghi sẵn để phát lại qua vòng lặp camera')
+    parser.add_argument('--video_faces', help='Thư mục ảnh đăng ký ({employee_id}_{name}.jpg) cho người trong video, mặc định --sample_images')
+    parser.add_argument('--models', nargs='+', default=['hog'], choices=['hog', 'cnn'])
+    parser.add_argument('--frame_scales', type=float, nargs='+', default=[0.25])
+    parser.add_argument('--no_realtime', action='store_true', help='Đọc video nhanh nhất có thể thay vì theo FPS của file')
+    parser.add_argument('--video_timeout', type=float, default=300)
+    parser.add_argument('--keep_workdir', action='store_true')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    base_config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8-sig') as f:
+            base_config = json.load(f)
+    # Người trong video chỉ khớp được với ảnh chụp thật, không dùng ảnh tổng hợp
+    video_faces = list_sample_images(args.video_faces or args.sample_images)
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__
+        },
+        "parameters": {k: v for k, v in vars(args).items() if k not in ("output", "keep_workdir")}
+    }
+
+    workdir = tempfile.mkdtemp(prefix="face-benchmark-")
+    workspace = BenchmarkWorkspace(base_config, workdir)
+    try:
+        sample_images = list_sample_images(args.sample_images)
+        report["samples"] = "provided" if sample_images else "synthetic"
+        if not sample_images:
+            sample_images = generate_sample_images(os.path.join(workdir, "samples"), args.synthetic_samples,
+                                                   np.random.default_rng(args.seed + 1))
+            print(f"No --sample_images given, generated {len(sample_images)} synthetic faces", file=sys.stderr)
+
+        report["matching"] = []
+        for index in args.indexes:
+            report["matching"].extend(bench_matching(workspace, args.gallery_sizes, args.queries, index, rng))
+
+        if sample_images:
+            report["load_known_faces"] = bench_gallery_load(workspace, sample_images, args.load_gallery_size)
+            report["register_delete"] = bench_register_delete(workspace, sample_images, args.register_count)
+
+        report["video"] = []
+        for video_path in args.video:
+            for model in args.models:
+                for frame_scale in args.frame_scales:
+                    report["video"].append(bench_video(workspace, video_path, model, frame_scale, video_faces,
+                                                       not args.no_realtime, args.video_timeout))
+
+        report["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        if args.keep_workdir:
+            print(f"Benchmark workdir: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    atomic_write_json(args.output, report)
+    print(json.dumps({"success": True, "output": args.output}, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ import os
 import locale
 import signal
 import threading
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
 
 # Set encoding cho Windows
 if sys.platform.startswith('win'):
@@ -32,26 +32,1636 @@ import argparse
 import time
 import unicodedata
 import re
+import hashlib
+import uuid
+import socketserver
+import functools
+import csv
+import queue
+import logging
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+ENCODING_SIZE = 128
+# Mốc chấm điểm chất lượng ảnh đăng ký: cạnh khuôn mặt (px) và phương sai Laplacian đạt điểm tối đa
+FACE_QUALITY_TARGET_SIZE = 120
+FACE_QUALITY_TARGET_SHARPNESS = 100.0
+# Khoảng cách encoding coi như cùng một ảnh (chỉ khác nhiễu do jitter khi encode)
+SAME_PHOTO_DISTANCE = 0.05
 
 class TimeoutException(Exception):
     pass
 
+def atomic_write_json(path, data):
+    """Ghi file JSON theo kiểu atomic (ghi file tạm rồi os.replace)"""
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            try:
+                os.remove(temp_path)
+            except:
+                pass
+
+def file_sha1(path, chunk_size=1024 * 1024):
+    """Tính SHA-1 nội dung file"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def collect_image_paths(image_path=None, image_list=None):
+    """Danh sách ảnh từ một thư mục (duyệt đệ quy) và/hoặc file danh sách (mỗi dòng một đường dẫn)"""
+    image_paths = []
+    if image_path and os.path.isdir(image_path):
+        for root, dirs, files in os.walk(image_path):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    image_paths.append(os.path.join(root, filename))
+    elif image_path:
+        image_paths.append(image_path)
+    
+    if image_list:
+        with open(image_list, 'r', encoding='utf-8') as f:
+            image_paths.extend(line.strip() for line in f if line.strip())
+    return image_paths
+
+def load_registration_manifest(manifest_path):
+    """Đọc manifest đăng ký hàng loạt (CSV có header hoặc JSONL).
+
+    Mỗi dòng gồm employee_id, employee_name, image_path; đường dẫn tương đối
+    được tính theo thư mục chứa manifest.
+    """
+    if manifest_path.lower().endswith(('.jsonl', '.json')):
+        with open(manifest_path, 'r', encoding='utf-8-sig') as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(manifest_path, 'r', encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.DictReader(f))
+    
+    base_folder = os.path.dirname(os.path.abspath(manifest_path))
+    manifest = []
+    for row in rows:
+        row = {key.strip(): str(value).strip() for key, value in row.items() if key and value is not None}
+        image_path = row.get("image_path")
+        if image_path and not os.path.isabs(image_path):
+            row["image_path"] = os.path.join(base_folder, image_path)
+        manifest.append(row)
+    return manifest
+
+def decode_image_bytes(image_bytes):
+    """Giải mã ảnh (JPEG/PNG/...) trực tiếp từ bytes trong bộ nhớ, trả về mảng RGB"""
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Không giải mã được dữ liệu ảnh")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def limit_image_size(image, max_dimension):
+    """Thu nhỏ ảnh nếu cạnh dài vượt max_dimension (0 = không giới hạn)"""
+    if not max_dimension:
+        return image
+    height, width = image.shape[:2]
+    longest = max(height, width)
+    if longest <= max_dimension:
+        return image
+    scale = max_dimension / float(longest)
+    return cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+
+def decode_base64_image(data_uri):
+    """Giải mã chuỗi data:image/...;base64,... thành mảng RGB"""
+    return decode_image_bytes(base64.b64decode(data_uri.split(',', 1)[1]))
+
+def detect_and_encode_image(rgb_image, model="hog", upsample=1, num_jitters=1):
+    """Phát hiện khuôn mặt rồi tính encoding 128 chiều cho từng khuôn mặt"""
+    face_locations = face_recognition.face_locations(
+        rgb_image, number_of_times_to_upsample=upsample, model=model
+    )
+    if len(face_locations) == 0:
+        return [], []
+    face_encodings = face_recognition.face_encodings(rgb_image, face_locations, num_jitters=num_jitters)
+    return face_locations, face_encodings
+
+def face_quality(rgb_image, face_location):
+    """Chấm điểm chất lượng khuôn mặt trong ảnh đăng ký (0..1).
+
+    Điểm là trung bình nhân của ba thành phần: kích thước khuôn mặt, độ nét
+    (phương sai Laplacian trên vùng mặt đưa về 112x112) và tư thế (lệch trái/phải
+    ước lượng từ vị trí mũi so với hai mắt, nghiêng đầu từ đường nối hai mắt).
+    """
+    top, right, bottom, left = (int(v) for v in face_location)
+    height, width = rgb_image.shape[:2]
+    top, left = max(0, top), max(0, left)
+    bottom, right = min(height, bottom), min(width, right)
+    face_size = max(0, min(bottom - top, right - left))
+    size_score = min(1.0, face_size / float(FACE_QUALITY_TARGET_SIZE))
+    
+    sharpness = 0.0
+    if face_size > 0:
+        gray = cv2.cvtColor(np.ascontiguousarray(rgb_image[top:bottom, left:right]), cv2.COLOR_RGB2GRAY)
+        sharpness = float(cv2.Laplacian(cv2.resize(gray, (112, 112)), cv2.CV_64F).var())
+    sharpness_score = min(1.0, sharpness / FACE_QUALITY_TARGET_SHARPNESS)
+    
+    yaw, roll, pose_score = None, None, 1.0
+    try:
+        landmarks = face_recognition.face_landmarks(rgb_image, [face_location], model="small")[0]
+        left_eye = np.mean(landmarks["left_eye"], axis=0)
+        right_eye = np.mean(landmarks["right_eye"], axis=0)
+        nose = np.mean(landmarks["nose_tip"], axis=0)
+        eye_vector = right_eye - left_eye
+        eye_distance = float(np.linalg.norm(eye_vector))
+        if eye_distance > 0:
+            # Mũi lệch khỏi trung điểm hai mắt (theo hướng đường mắt) ~ góc quay trái/phải
+            yaw = float(np.dot(nose - (left_eye + right_eye) / 2.0, eye_vector) / (eye_distance ** 2))
+            roll = float(np.degrees(np.arctan2(eye_vector[1], eye_vector[0])))
+            pose_score = max(0.0, 1.0 - abs(yaw) / 0.5) * max(0.0, 1.0 - abs(roll) / 45.0)
+    except Exception:
+        pass  # Không lấy được landmark: không trừ điểm tư thế
+    
+    score = (size_score * sharpness_score * pose_score) ** (1.0 / 3.0)
+    return {
+        "score": round(float(score), 4),
+        "face_size": face_size,
+        "sharpness": round(sharpness, 2),
+        "yaw": None if yaw is None else round(yaw, 3),
+        "roll": None if roll is None else round(roll, 1)
+    }
+
+def encode_image_file(image_path, settings, max_dimension=0, with_quality=False):
+    """Đọc và encode một file ảnh (chạy được trong worker process)"""
+    try:
+        image = limit_image_size(face_recognition.load_image_file(image_path), max_dimension)
+        face_locations, face_encodings = detect_and_encode_image(image, **settings)
+        result = {
+            "image": image_path,
+            "face_locations": [tuple(int(v) for v in location) for location in face_locations],
+            "encodings": [np.asarray(encoding, dtype=np.float32) for encoding in face_encodings]
+        }
+        if with_quality:
+            result["qualities"] = [face_quality(image, location) for location in face_locations]
+        return result
+    except Exception as e:
+        return {"image": image_path, "error": str(e)}
+
+logger = logging.getLogger("face_recognition_service")
+
+class JsonLogFormatter(logging.Formatter):
+    """Mỗi bản ghi log là một dòng JSON: time, level, event và các trường bổ sung"""
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "event": record.getMessage()
+        }
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+def configure_logging(logging_config):
+    """Cấu hình log JSON theo mục "logging" trong config.json"""
+    logger.handlers = []
+    logger.propagate = False
+    if not logging_config.get("enable_logging", False):
+        logger.addHandler(logging.NullHandler())
+        return
+    
+    handler = logging.FileHandler(logging_config.get("log_file", "face_recognition.log"), encoding='utf-8')
+    handler.setFormatter(JsonLogFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(getattr(logging, str(logging_config.get("log_level", "INFO")).upper(), logging.INFO))
+
+class ServiceMetrics:
+    """Đo thời gian từng giai đoạn (span) và đếm sự kiện, thread-safe.
+
+    Mỗi span giữ tối đa max_samples mẫu gần nhất (ms) để tính p50/p95/p99. Số liệu
+    được cộng dồn vào metrics_file khi service đóng, để action "stats" đọc được
+    số liệu của nhiều lần chạy CLI.
+    """
+    def __init__(self, metrics_file=None, max_samples=5000):
+        self.metrics_file = metrics_file
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.samples = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000.0)
+
+    def record(self, name, duration_ms):
+        with self.lock:
+            values = self.samples.setdefault(name, [])
+            values.append(round(duration_ms, 3))
+            if len(values) > self.max_samples:
+                del values[:len(values) - self.max_samples]
+
+    def increment(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def _load_persisted(self):
+        if not self.metrics_file or not os.path.exists(self.metrics_file):
+            return {}, {}
+        try:
+            with open(self.metrics_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data.get("counters", {}), data.get("samples", {})
+        except Exception as e:
+            print(f"Error loading metrics: {str(e)}", file=sys.stderr)
+            return {}, {}
+
+    def _merged(self):
+        counters, samples = self._load_persisted()
+        with self.lock:
+            for name, count in self.counters.items():
+                counters[name] = counters.get(name, 0) + count
+            for name, values in self.samples.items():
+                samples[name] = (samples.get(name, []) + values)[-self.max_samples:]
+        return counters, samples
+
+    def snapshot(self):
+        """Tổng hợp counters và phân vị độ trễ (ms) của mọi span"""
+        counters, samples = self._merged()
+        latency = {}
+        for name, values in sorted(samples.items()):
+            if not values:
+                continue
+            data = np.asarray(values, dtype=np.float64)
+            p50, p95, p99 = np.percentile(data, [50, 95, 99])
+            latency[name] = {
+                "count": int(len(data)),
+                "mean": round(float(data.mean()), 3),
+                "p50": round(float(p50), 3),
+                "p95": round(float(p95), 3),
+                "p99": round(float(p99), 3),
+                "max": round(float(data.max()), 3)
+            }
+        return {"counters": dict(sorted(counters.items())), "latency_ms": latency}
+
+    def flush(self):
+        """Cộng dồn số liệu của lần chạy này vào metrics_file"""
+        if not self.metrics_file:
+            return
+        with self.lock:
+            has_data = bool(self.counters or self.samples)
+        if not has_data:
+            return
+        counters, samples = self._merged()
+        atomic_write_json(self.metrics_file, {"counters": counters, "samples": samples})
+        with self.lock:
+            self.counters = {}
+            self.samples = {}
+
+class FaceEncodingStore:
+    """Cache encoding trên đĩa: ma trận float32 (.npy) + file index JSON đi kèm.
+
+    Mỗi entry trong index ứng với một file ảnh trong thư mục faces, được nhận diện
+    bằng tên file, mtime, kích thước và SHA-1 nội dung. Entry có "row" là vị trí
+    encoding trong ma trận, hoặc None nếu ảnh không có khuôn mặt.
+
+    Thay đổi lẻ (đăng ký/xóa) được ghi vào journal.jsonl; journal được gộp vào
+    ma trận ở lần save() tiếp theo.
+    """
+    INDEX_FILENAME = "index.json"
+    JOURNAL_FILENAME = "journal.jsonl"
+    IVF_FILENAME = "ivf_centroids.npz"
+    VERSION = 1
+    MAX_JOURNAL_LENGTH = 500
+
+    def __init__(self, cache_folder, encoder_settings=None):
+        self.cache_folder = cache_folder
+        self.encoder_settings = encoder_settings or {}
+        self.index_path = os.path.join(cache_folder, self.INDEX_FILENAME)
+        self.journal_path = os.path.join(cache_folder, self.JOURNAL_FILENAME)
+        self.journal_length = 0
+
+    def load(self):
+        """Đọc cache và replay journal, trả về (entries, matrix). Cache hỏng/không khớp được bỏ qua."""
+        entries, matrix = self._load_snapshot()
+        records = self._read_journal()
+        self.journal_length = len(records)
+        if not records:
+            return entries, matrix
+
+        # Replay journal: add/remove theo tên file nên replay nhiều lần vẫn cho cùng kết quả
+        entries_by_file = {entry["file"]: entry for entry in entries}
+        extra_rows = []
+        for record in records:
+            if record.get("op") == "add":
+                entry = dict(record["entry"])
+                if record.get("encoding") is not None:
+                    entry["row"] = len(matrix) + len(extra_rows)
+                    extra_rows.append(np.asarray(record["encoding"], dtype=np.float32))
+                else:
+                    entry["row"] = None
+                entries_by_file[entry["file"]] = entry
+            elif record.get("op") == "remove":
+                for filename in record.get("files", []):
+                    entries_by_file.pop(filename, None)
+
+        if extra_rows:
+            matrix = np.vstack([np.asarray(matrix, dtype=np.float32)] + extra_rows)
+        return list(entries_by_file.values()), matrix
+
+    def _load_snapshot(self):
+        """Đọc ma trận + index đã compact"""
+        empty = ([], np.zeros((0, ENCODING_SIZE), dtype=np.float32))
+        if not os.path.exists(self.index_path):
+            return empty
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get("version") != self.VERSION or index.get("encoder_settings", {}) != self.encoder_settings:
+                # Encoding tính với tham số khác (model, jitters...) không còn dùng được
+                self.discard_journal()
+                return empty
+            entries = index.get("entries", [])
+            row_count = index.get("row_count", 0)
+            if row_count == 0:
+                return entries, empty[1]
+            matrix_path = os.path.join(self.cache_folder, index["matrix_file"])
+            matrix = np.load(matrix_path, mmap_mode='r')
+            if matrix.dtype != np.float32 or matrix.shape != (row_count, ENCODING_SIZE):
+                return empty
+            return entries, matrix
+        except Exception as e:
+            print(f"Error loading encoding cache: {str(e)}", file=sys.stderr)
+            return empty
+
+    def _read_journal(self):
+        """Đọc các bản ghi journal; dòng cuối bị ghi dở (crash) sẽ bị bỏ qua"""
+        if not os.path.exists(self.journal_path):
+            return []
+        records = []
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+        return records
+
+    def append_journal(self, record):
+        """Ghi thêm một thay đổi (add/remove) vào journal, O(1) thay vì ghi lại cả ma trận"""
+        os.makedirs(self.cache_folder, exist_ok=True)
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_length += 1
+
+    def save(self, entries, matrix):
+        """Ghi cache theo kiểu atomic: ghi ma trận mới, thay index, rồi dọn ma trận cũ"""
+        os.makedirs(self.cache_folder, exist_ok=True)
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+
+        matrix_file = None
+        if len(matrix) > 0:
+            matrix_file = f"encodings-{uuid.uuid4().hex}.npy"
+            matrix_path = os.path.join(self.cache_folder, matrix_file)
+            with open(matrix_path, 'wb') as f:
+                np.save(f, matrix)
+                f.flush()
+                os.fsync(f.fileno())
+
+        atomic_write_json(self.index_path, {
+            "version": self.VERSION,
+            "encoder_settings": self.encoder_settings,
+            "row_count": len(matrix),
+            "matrix_file": matrix_file,
+            "entries": entries
+        })
+        # Index mới đã chứa mọi thay đổi trong journal
+        self.discard_journal()
+        self._remove_stale_matrices(keep=matrix_file)
+
+    def discard_journal(self):
+        """Xóa journal"""
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_length = 0
+
+    def load_ivf_centroids(self):
+        """Đọc centroid IVF đã train, trả về (centroids, trained_size) hoặc (None, 0)"""
+        path = os.path.join(self.cache_folder, self.IVF_FILENAME)
+        if not os.path.exists(path):
+            return None, 0
+        try:
+            with np.load(path) as data:
+                centroids = np.asarray(data["centroids"], dtype=np.float32)
+                trained_size = int(data["trained_size"])
+            if centroids.ndim != 2 or centroids.shape[1] != ENCODING_SIZE:
+                return None, 0
+            return centroids, trained_size
+        except Exception as e:
+            print(f"Error loading IVF index: {str(e)}", file=sys.stderr)
+            return None, 0
+
+    def save_ivf_centroids(self, centroids, trained_size):
+        """Ghi centroid IVF theo kiểu atomic"""
+        os.makedirs(self.cache_folder, exist_ok=True)
+        path = os.path.join(self.cache_folder, self.IVF_FILENAME)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, centroids=centroids, trained_size=trained_size)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _remove_stale_matrices(self, keep):
+        """Xóa các file ma trận cũ không còn được index tham chiếu"""
+        for filename in os.listdir(self.cache_folder):
+            if filename.startswith("encodings-") and filename.endswith(".npy") and filename != keep:
+                try:
+                    os.remove(os.path.join(self.cache_folder, filename))
+                except Exception:
+                    pass  # File có thể đang bị mmap (Windows), sẽ dọn ở lần lưu sau
+
+class IVFIndex:
+    """Index xấp xỉ IVF (inverted file) cho gallery lớn.
+
+    k-means chia các encoding thành nlist cụm; khi tìm kiếm chỉ quét các dòng thuộc
+    nprobe cụm gần query nhất. nprobe là nút chỉnh recall/độ trễ: càng lớn càng
+    gần kết quả quét tuyến tính. Khoảng cách của các ứng viên luôn được tính chính xác.
+    """
+    def __init__(self, nlist=0, nprobe=8, iterations=10, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self.lists = []
+        self.row_lists = {}
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, encodings):
+        """Train centroid bằng k-means (Lloyd) trên các encoding hiện có"""
+        encodings = np.asarray(encodings, dtype=np.float32)
+        nlist = self.nlist or int(np.sqrt(len(encodings)))
+        nlist = max(1, min(nlist, len(encodings)))
+        
+        rng = np.random.RandomState(self.seed)
+        centroids = encodings[rng.choice(len(encodings), nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            assignments = self._nearest_centroids(encodings, centroids, 1)[:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, encodings)
+            counts = np.bincount(assignments, minlength=nlist)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+        self.centroids = centroids
+
+    def rebuild(self, encodings):
+        """Gán lại toàn bộ dòng của gallery vào các cụm"""
+        self.lists = [set() for _ in range(len(self.centroids))]
+        self.row_lists = {}
+        if len(encodings) == 0:
+            return
+        assignments = self._nearest_centroids(encodings, self.centroids, 1)[:, 0]
+        for row, list_id in enumerate(assignments):
+            self.lists[list_id].add(row)
+            self.row_lists[row] = list_id
+
+    def add_row(self, row, encoding):
+        list_id = self._nearest_centroids(encoding, self.centroids, 1)[0, 0]
+        self.lists[list_id].add(row)
+        self.row_lists[row] = list_id
+
+    def remove_row(self, row):
+        list_id = self.row_lists.pop(row, None)
+        if list_id is not None:
+            self.lists[list_id].discard(row)
+
+    def move_row(self, source_row, target_row):
+        """Cập nhật khi gallery chuyển dòng source_row sang vị trí target_row"""
+        list_id = self.row_lists.pop(source_row, None)
+        if list_id is not None:
+            self.lists[list_id].discard(source_row)
+            self.lists[list_id].add(target_row)
+            self.row_lists[target_row] = list_id
+
+    def candidates(self, queries):
+        """Danh sách dòng ứng viên cho từng query"""
+        probes = self._nearest_centroids(queries, self.centroids, min(self.nprobe, len(self.centroids)))
+        result = []
+        for query_probes in probes:
+            rows = []
+            for list_id in query_probes:
+                rows.extend(self.lists[list_id])
+            result.append(np.fromiter(rows, dtype=np.int64, count=len(rows)))
+        return result
+
+    @staticmethod
+    def _nearest_centroids(vectors, centroids, count):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        sq_distances = np.einsum('ij,ij->i', centroids, centroids)[np.newaxis, :] - 2.0 * (vectors @ centroids.T)
+        if count < len(centroids):
+            nearest = np.argpartition(sq_distances, count - 1, axis=1)[:, :count]
+            order = np.argsort(np.take_along_axis(sq_distances, nearest, axis=1), axis=1)
+            return np.take_along_axis(nearest, order, axis=1)
+        return np.argsort(sq_distances, axis=1)
+
+class FaceGallery:
+    """Gallery encoding dạng ma trận float32 liên tục, có sẵn bình phương norm từng dòng.
+
+    Thêm dòng là O(1) khấu hao (ma trận tăng dung lượng gấp đôi), xóa dòng là O(1)
+    (đổi chỗ với dòng cuối). match() so khớp cả batch encoding trong một phép nhân ma trận.
+    Mỗi nhân viên có thể có nhiều dòng (nhiều ảnh); với templates=True gallery giữ
+    thêm một template mỗi nhân viên (trung bình encoding có trọng số theo chất lượng
+    ảnh) trong một FaceGallery con để match_identities() lọc ứng viên trước.
+    """
+    def __init__(self, capacity=64, templates=False):
+        self.matrix = np.zeros((capacity, ENCODING_SIZE), dtype=np.float32)
+        self.sq_norms = np.zeros(capacity, dtype=np.float32)
+        self.employee_ids = []
+        self.employee_names = []
+        self.files = []
+        self.qualities = []
+        self.file_rows = {}
+        self.employee_rows = {}
+        self.templates = FaceGallery(templates=False) if templates else None
+        self.index = None
+        self.index_min_size = 0
+
+    def __len__(self):
+        return len(self.files)
+
+    @property
+    def encodings(self):
+        """View (không copy) các dòng đang dùng của ma trận"""
+        return self.matrix[:len(self.files)]
+
+    def add(self, filename, employee_id, employee_name, encoding, quality=1.0):
+        """Thêm một encoding (quality: điểm chất lượng ảnh 0..1), trả về chỉ số dòng"""
+        if filename in self.file_rows:
+            self.remove(filename)
+        
+        row = len(self.files)
+        if row == len(self.matrix):
+            self._grow(max(64, row * 2))
+        encoding = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+        self.matrix[row] = encoding
+        self.sq_norms[row] = np.dot(encoding, encoding)
+        self.employee_ids.append(employee_id)
+        self.employee_names.append(employee_name)
+        self.files.append(filename)
+        self.qualities.append(float(quality))
+        self.file_rows[filename] = row
+        self.employee_rows.setdefault(employee_id, set()).add(row)
+        if self.index is not None:
+            self.index.add_row(row, encoding)
+        self.update_template(employee_id)
+        return row
+
+    def attach_index(self, index, min_size=0):
+        """Gắn index xấp xỉ (đã train); gallery nhỏ hơn min_size vẫn quét tuyến tính"""
+        self.index = index
+        self.index_min_size = min_size
+        index.rebuild(self.encodings)
+
+    def remove(self, filename):
+        """Xóa dòng của một file, đổi chỗ với dòng cuối"""
+        row = self.file_rows.pop(filename, None)
+        if row is None:
+            return False
+        
+        last = len(self.files) - 1
+        employee_id = self.employee_ids[row]
+        self.employee_rows[employee_id].discard(row)
+        if self.index is not None:
+            self.index.remove_row(row)
+            if row != last:
+                self.index.move_row(last, row)
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.sq_norms[row] = self.sq_norms[last]
+            for values in (self.employee_ids, self.employee_names, self.files, self.qualities):
+                values[row] = values[last]
+            self.file_rows[self.files[row]] = row
+            moved_rows = self.employee_rows[self.employee_ids[row]]
+            moved_rows.discard(last)
+            moved_rows.add(row)
+        for values in (self.employee_ids, self.employee_names, self.files, self.qualities):
+            values.pop()
+        
+        if not self.employee_rows[employee_id]:
+            del self.employee_rows[employee_id]
+        self.update_template(employee_id)
+        return True
+
+    def update_template(self, employee_id):
+        """Tính lại template của một nhân viên: trung bình encoding có trọng số chất lượng"""
+        if self.templates is None:
+            return
+        rows = sorted(self.employee_rows.get(employee_id, ()))
+        if not rows:
+            self.templates.remove(employee_id)
+            return
+        # Ảnh chất lượng kém vẫn góp một phần nhỏ thay vì bị loại hẳn
+        weights = np.maximum([self.qualities[row] for row in rows], 0.05).astype(np.float32)
+        centroid = weights @ self.matrix[rows] / weights.sum()
+        self.templates.add(employee_id, employee_id, self.employee_names[rows[0]], centroid, float(weights.max()))
+
+    def _grow(self, capacity):
+        """Tăng dung lượng ma trận"""
+        matrix = np.zeros((capacity, ENCODING_SIZE), dtype=np.float32)
+        sq_norms = np.zeros(capacity, dtype=np.float32)
+        matrix[:len(self.files)] = self.encodings
+        sq_norms[:len(self.files)] = self.sq_norms[:len(self.files)]
+        self.matrix, self.sq_norms = matrix, sq_norms
+
+    def match(self, query_encodings, k=1):
+        """So khớp top-k cho một batch encoding.
+
+        Trả về (rows, distances) kích thước (số query, k'), k' = min(k, len(gallery)),
+        mỗi hàng sắp xếp theo khoảng cách Euclid tăng dần. Khi dùng index xấp xỉ, chỗ
+        trống (ít ứng viên hơn k') có row = -1 và distance = inf.
+        """
+        queries = np.asarray(query_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        size = len(self.files)
+        k = min(k, size)
+        if k == 0 or len(queries) == 0:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        
+        if self.index is not None and size >= self.index_min_size:
+            return self._match_candidates(queries, self.index.candidates(queries), k)
+        return self._top_k(queries, None, k)
+
+    def match_identities(self, query_encodings, candidates=5, k=1):
+        """So khớp theo nhân viên: top-k nhân viên khác nhau, cùng định dạng kết quả với match().
+
+        Bước 1 so với template của mọi nhân viên (số dòng = số nhân viên, không phải
+        số ảnh) để lấy `candidates` nhân viên gần nhất; bước 2 tính khoảng cách chính
+        xác tới từng ảnh của các ứng viên đó. Khoảng cách của một nhân viên là giá trị
+        nhỏ hơn giữa template và ảnh gần nhất, nên nhiều ảnh/tư thế giúp giảm từ chối nhầm.
+        Mỗi nhân viên xuất hiện tối đa một lần, nên cột thứ hai cho biết người gần thứ nhì.
+        """
+        queries = np.asarray(query_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        k = min(k, len(self.employee_rows))
+        if k == 0 or len(queries) == 0:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        if self.templates is None:
+            # Không có template: lấy dư ứng viên theo dòng rồi giữ dòng gần nhất của mỗi nhân viên
+            row_candidates, row_distances = self.match(queries, k=k * 8)
+            for i in range(len(queries)):
+                seen, position = set(), 0
+                for row, distance in zip(row_candidates[i], row_distances[i]):
+                    if row < 0 or self.employee_ids[row] in seen:
+                        continue
+                    seen.add(self.employee_ids[row])
+                    rows[i, position], distances[i, position] = row, distance
+                    position += 1
+                    if position == k:
+                        break
+            return rows, distances
+        
+        template_rows, template_distances = self.templates.match(queries, k=max(candidates, k))
+        for i in range(len(queries)):
+            scored = []
+            for template_row, template_distance in zip(template_rows[i], template_distances[i]):
+                if template_row < 0:
+                    continue
+                employee_rows = self.employee_rows[self.templates.files[template_row]]
+                if len(employee_rows) == 1:
+                    # Một ảnh: template chính là encoding của ảnh đó
+                    scored.append((float(template_distance), next(iter(employee_rows))))
+                    continue
+                candidate_rows = np.fromiter(employee_rows, dtype=np.int64, count=len(employee_rows))
+                best_rows, best_distances = self._top_k(queries[i:i + 1], candidate_rows, 1)
+                scored.append((float(min(best_distances[0, 0], template_distance)), best_rows[0, 0]))
+            scored.sort()
+            for position, (distance, row) in enumerate(scored[:k]):
+                rows[i, position], distances[i, position] = row, distance
+        return rows, distances
+
+    def _match_candidates(self, queries, candidate_rows, k):
+        """Tính khoảng cách chính xác trên tập ứng viên riêng của từng query"""
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for i, candidates in enumerate(candidate_rows):
+            if len(candidates) == 0:
+                continue
+            query_rows, query_distances = self._top_k(queries[i:i + 1], candidates, k)
+            rows[i, :query_rows.shape[1]] = query_rows[0]
+            distances[i, :query_rows.shape[1]] = query_distances[0]
+        return rows, distances
+
+    def _top_k(self, queries, candidates, k):
+        """Top-k chính xác của queries trong các dòng candidates (None = toàn bộ gallery)"""
+        if candidates is None:
+            gallery, sq_norms = self.encodings, self.sq_norms[:len(self.files)]
+        else:
+            gallery, sq_norms = self.matrix[candidates], self.sq_norms[candidates]
+        count = len(gallery)
+        k = min(k, count)
+        
+        # ||q - g||^2 = ||q||^2 + ||g||^2 - 2 q.g
+        sq_distances = sq_norms[np.newaxis, :] - 2.0 * (queries @ gallery.T)
+        sq_distances += np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+        
+        if k < count:
+            positions = np.argpartition(sq_distances, k - 1, axis=1)[:, :k]
+        else:
+            positions = np.broadcast_to(np.arange(count), sq_distances.shape)
+        top = np.take_along_axis(sq_distances, positions, axis=1)
+        order = np.argsort(top, axis=1)
+        rows = np.take_along_axis(positions, order, axis=1)
+        if candidates is not None:
+            rows = candidates[rows]
+        distances = np.sqrt(np.maximum(np.take_along_axis(top, order, axis=1), 0.0))
+        return rows, distances
+
+class FrameSource(ABC):
+    """Nguồn frame cho vòng lặp nhận diện (camera, video, thư mục ảnh, shared memory).
+
+    Giao diện giống cv2.VideoCapture (isOpened/read/release) để LatestFrameGrabber
+    dùng chung. Lớp con phải cài open() và _read_frame() (thiếu thì lỗi ngay khi tạo
+    đối tượng); lớp cơ sở lo phần chung:
+    - width/height: đưa frame về kích thước này nếu nguồn không tự đặt được
+    - fps: giới hạn tốc độ đọc (0 = không giới hạn)
+    - buffer_size: với nguồn hữu hạn (video, thư mục) là số frame giải mã trước
+      trên một thread riêng; camera và shared memory tự diễn giải
+    Nguồn hữu hạn (finite=True) trả về (False, None) khi hết frame.
+    """
+    finite = False
+
+    def __init__(self, width=0, height=0, fps=0, buffer_size=1):
+        self.width = int(width or 0)
+        self.height = int(height or 0)
+        self.fps = float(fps or 0)
+        self.buffer_size = max(1, int(buffer_size or 1))
+        self.opened = False
+        self.next_frame_time = None
+        self.prefetch_queue = None
+        self.prefetch_thread = None
+        self.stopped = threading.Event()
+
+    @abstractmethod
+    def open(self):
+        """Mở nguồn, trả về True nếu thành công"""
+
+    @abstractmethod
+    def _read_frame(self):
+        """Đọc frame kế tiếp, trả về (ret, frame) như cv2.VideoCapture.read()"""
+
+    def _close(self):
+        pass
+
+    def isOpened(self):
+        if not self.opened:
+            self.opened = bool(self.open())
+            if self.opened and self.finite and self.buffer_size > 1:
+                self.prefetch_queue = queue.Queue(maxsize=self.buffer_size)
+                self.prefetch_thread = threading.Thread(target=self._prefetch, name="frame-prefetch", daemon=True)
+                self.prefetch_thread.start()
+        return self.opened
+
+    def read(self):
+        if not self.isOpened():
+            return False, None
+        if self.fps > 0:
+            # Giới hạn FPS: giãn các lần đọc theo chu kỳ cố định
+            now = time.perf_counter()
+            if self.next_frame_time is None or self.next_frame_time < now - 1.0:
+                self.next_frame_time = now
+            elif self.next_frame_time > now:
+                time.sleep(self.next_frame_time - now)
+            self.next_frame_time += 1.0 / self.fps
+        
+        if self.prefetch_queue is not None:
+            ret, frame = self.prefetch_queue.get()
+            if not ret:
+                self.prefetch_queue.put((False, None))  # Giữ trạng thái hết frame cho lần đọc sau
+        else:
+            ret, frame = self._read_frame()
+        if not ret or frame is None:
+            return False, None
+        return True, self._resize(frame)
+
+    def release(self):
+        self.stopped.set()
+        if self.prefetch_queue is not None:
+            try:
+                while True:
+                    self.prefetch_queue.get_nowait()
+            except queue.Empty:
+                pass
+        if self.prefetch_thread is not None:
+            self.prefetch_thread.join(timeout=1.0)
+        if self.opened:
+            self._close()
+        self.opened = False
+
+    def _prefetch(self):
+        while not self.stopped.is_set():
+            ret, frame = self._read_frame()
+            while not self.stopped.is_set():
+                try:
+                    self.prefetch_queue.put((ret, frame), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if not ret:
+                return
+
+    def _resize(self, frame):
+        if not self.width or not self.height:
+            return frame
+        if frame.shape[1] == self.width and frame.shape[0] == self.height:
+            return frame
+        return cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
+
+class CameraSource(FrameSource):
+    """Camera cục bộ (hoặc URL/RTSP mà cv2.VideoCapture mở được); buffer_size là buffer của driver"""
+    def __init__(self, index=0, **options):
+        super().__init__(**options)
+        self.index = index
+        self.capture = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.index)
+        if not self.capture.isOpened():
+            return False
+        if self.width and self.height:
+            self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+            self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        self.capture.set(cv2.CAP_PROP_FPS, self.fps or 30)
+        # Giữ buffer của driver nhỏ để không nhận frame cũ
+        self.capture.set(cv2.CAP_PROP_BUFFERSIZE, self.buffer_size)
+        return True
+
+    def _read_frame(self):
+        return self.capture.read()
+
+    def _close(self):
+        self.capture.release()
+
+class VideoFileSource(FrameSource):
+    """Phát lại video ghi sẵn. realtime=True đọc theo FPS của file như một camera thật"""
+    finite = True
+
+    def __init__(self, path, realtime=True, loop=False, **options):
+        super().__init__(**options)
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.capture = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.capture.isOpened():
+            return False
+        if self.realtime and not self.fps:
+            self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+        return True
+
+    def _read_frame(self):
+        ret, frame = self.capture.read()
+        if not ret and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.capture.read()
+        return ret, frame
+
+    def _close(self):
+        self.capture.release()
+
+class ImageDirectorySource(FrameSource):
+    """Phát lại các ảnh trong một thư mục theo thứ tự tên file"""
+    finite = True
+
+    def __init__(self, path, loop=False, **options):
+        super().__init__(**options)
+        self.path = path
+        self.loop = loop
+        self.image_paths = []
+        self.position = 0
+
+    def open(self):
+        if not os.path.isdir(self.path):
+            return False
+        self.image_paths = collect_image_paths(self.path)
+        return len(self.image_paths) > 0
+
+    def _read_frame(self):
+        while True:
+            if self.position >= len(self.image_paths):
+                if not self.loop:
+                    return False, None
+                self.position = 0
+            image_path = self.image_paths[self.position]
+            self.position += 1
+            frame = cv2.imread(image_path)
+            if frame is not None:
+                return True, frame
+            print(f"Error loading frame {image_path}", file=sys.stderr)
+
+class SharedFrameBuffer:
+    """Vùng shared memory chứa ring buffer frame BGR cho nhiều process đọc chung.
+
+    Header gồm 8 số int64: magic, sequence của frame mới nhất, chiều cao,
+    chiều rộng, số kênh, số slot, cờ publisher còn chạy, dự phòng. Frame thứ
+    sequence nằm ở slot (sequence % slots); publisher ghi frame trước rồi mới
+    tăng sequence nên reader chỉ thấy frame đã ghi xong.
+    """
+    MAGIC = 0x46524D42  # "FRMB"
+    HEADER_FIELDS = 8
+
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        self.header = np.ndarray((self.HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        height, width, channels, slots = (int(v) for v in self.header[2:6])
+        self.frame_shape = (height, width, channels)
+        self.slots = slots
+        self.frames = np.ndarray((slots,) + self.frame_shape, dtype=np.uint8, buffer=shm.buf,
+                                 offset=self.HEADER_FIELDS * 8)
+
+    @classmethod
+    def create(cls, name, frame_shape, slots):
+        if shared_memory is None:
+            raise RuntimeError("multiprocessing.shared_memory cần Python 3.8 trở lên")
+        size = cls.HEADER_FIELDS * 8 + slots * int(np.prod(frame_shape))
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((cls.HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[2:6] = list(frame_shape) + [slots]
+        header[0] = cls.MAGIC
+        del header
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        if shared_memory is None:
+            raise RuntimeError("multiprocessing.shared_memory cần Python 3.8 trở lên")
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+            if os.name == 'posix':
+                # Không để resource_tracker của process đọc xóa vùng nhớ khi thoát
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, "shared_memory")
+        if int(np.ndarray((1,), dtype=np.int64, buffer=shm.buf)[0]) != cls.MAGIC:
+            shm.close()
+            raise ValueError(f"Shared memory '{name}' không phải frame buffer")
+        return cls(shm)
+
+    @property
+    def sequence(self):
+        return int(self.header[1])
+
+    @property
+    def publisher_alive(self):
+        return bool(self.header[6])
+
+    def close(self):
+        del self.header, self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class SharedMemoryFramePublisher:
+    """Phía ghi của SharedFrameBuffer: một process capture đẩy frame cho nhiều recognizer"""
+    def __init__(self, name, buffer_size=4):
+        self.name = name
+        self.slots = max(2, int(buffer_size or 4))
+        self.buffer = None
+        self.frames_published = 0
+
+    def publish(self, frame):
+        if self.buffer is None:
+            # Kích thước frame cố định theo frame đầu tiên
+            self.buffer = SharedFrameBuffer.create(self.name, frame.shape if frame.ndim == 3 else frame.shape + (1,), self.slots)
+            self.buffer.header[6] = 1
+        height, width = self.buffer.frame_shape[:2]
+        if frame.shape[0] != height or frame.shape[1] != width:
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        sequence = self.buffer.sequence + 1
+        self.buffer.frames[sequence % self.slots] = frame.reshape(self.buffer.frame_shape)
+        self.buffer.header[1] = sequence
+        self.frames_published += 1
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.header[6] = 0
+            self.buffer.close()
+            self.buffer = None
+
+class SharedMemorySource(FrameSource):
+    """Đọc frame mới nhất từ SharedFrameBuffer do process khác (publish_frames) ghi.
+
+    Không giải mã hay serialize lại ảnh: mỗi lần đọc chỉ chép một frame từ ring
+    buffer. buffer_size ở đây là thời gian chờ frame mới (tính theo số frame) trước
+    khi báo đọc thất bại.
+    """
+    def __init__(self, name, **options):
+        super().__init__(**options)
+        self.name = name
+        self.buffer = None
+        self.last_sequence = 0
+
+    def open(self):
+        try:
+            self.buffer = SharedFrameBuffer.attach(self.name)
+        except Exception as e:
+            print(f"Error opening shared frame buffer {self.name}: {str(e)}", file=sys.stderr)
+            return False
+        self.last_sequence = self.buffer.sequence
+        return True
+
+    def _read_frame(self):
+        deadline = time.perf_counter() + self.buffer_size / (self.fps or 30.0)
+        while True:
+            sequence = self.buffer.sequence
+            if sequence > self.last_sequence:
+                frame = self.buffer.frames[sequence % self.buffer.slots].copy()
+                # Publisher đã ghi vòng qua slot này trong lúc chép: frame có thể bị lẫn, bỏ qua
+                if self.buffer.sequence - sequence < self.buffer.slots - 1:
+                    self.last_sequence = sequence
+                    return True, frame if frame.shape[2] > 1 else frame[:, :, 0]
+                continue
+            if time.perf_counter() > deadline or not self.buffer.publisher_alive:
+                return False, None
+            time.sleep(0.002)
+
+    def _close(self):
+        self.buffer.close()
+        self.buffer = None
+
+FRAME_SOURCE_TYPES = {
+    "camera": CameraSource,
+    "video": VideoFileSource,
+    "directory": ImageDirectorySource,
+    "shared_memory": SharedMemorySource
+}
+
+def parse_frame_source_spec(spec):
+    """Chuyển chuỗi --source thành cấu hình nguồn frame.
+
+    "0" → camera 0, "shm:<tên>" → shared memory, thư mục → ảnh trong thư mục,
+    file → video, còn lại (URL/RTSP) → cv2.VideoCapture.
+    """
+    if isinstance(spec, dict):
+        return dict(spec)
+    spec = str(spec)
+    if spec.isdigit():
+        return {"type": "camera", "index": int(spec)}
+    if spec.startswith("shm:"):
+        return {"type": "shared_memory", "name": spec[4:]}
+    if os.path.isdir(spec):
+        return {"type": "directory", "path": spec}
+    if os.path.isfile(spec):
+        return {"type": "video", "path": spec}
+    return {"type": "camera", "index": spec}
+
+def create_frame_source(source_config):
+    """Tạo FrameSource từ dict cấu hình {"type": ..., "width", "height", "fps", "buffer_size", ...}"""
+    options = dict(source_config)
+    source_type = options.pop("type", "camera")
+    source_class = FRAME_SOURCE_TYPES.get(source_type)
+    if source_class is None:
+        raise ValueError(f"Loại nguồn frame không hỗ trợ: {source_type}")
+    return source_class(**options)
+
+class LatestFrameGrabber:
+    """Thread đọc camera liên tục và chỉ giữ lại frame mới nhất.
+
+    Frame bị ghi đè trước khi được lấy ra được đếm vào frames_dropped, nhờ đó
+    pipeline phía sau luôn xử lý ảnh hiện tại thay vì ảnh cũ trong buffer.
+    Với stop_on_eof=True (phát lại video), lần read() thất bại đầu tiên được coi
+    là hết nguồn và đặt cờ exhausted thay vì thử đọc lại.
+    """
+    def __init__(self, capture, retry_delay=0.1, metrics=None, stop_on_eof=False):
+        self.capture = capture
+        self.retry_delay = retry_delay
+        self.metrics = metrics
+        self.stop_on_eof = stop_on_eof
+        self.exhausted = threading.Event()
+        self.frame_event = None  # Event dùng chung để báo vòng điều phối có frame mới
+        self.condition = threading.Condition()
+        self.frame = None
+        self.sequence = 0
+        self.consumed_sequence = 0
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="frame-grabber", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join(timeout=1.0)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            ret, frame = self.capture.read()
+            if self.metrics is not None:
+                self.metrics.record("frame_capture", (time.perf_counter() - start) * 1000.0)
+            if not ret:
+                if self.stop_on_eof:
+                    with self.condition:
+                        self.exhausted.set()
+                        self.condition.notify_all()
+                    if self.frame_event is not None:
+                        self.frame_event.set()
+                    return
+                time.sleep(self.retry_delay)
+                continue
+            with self.condition:
+                if self.frame is not None and self.consumed_sequence < self.sequence:
+                    self.frames_dropped += 1
+                self.frame = frame
+                self.sequence += 1
+                self.frames_captured += 1
+                self.condition.notify_all()
+            if self.frame_event is not None:
+                self.frame_event.set()
+
+    def wait_for_frame(self, after_sequence, timeout=None):
+        """Chờ frame có sequence > after_sequence, trả về (sequence, frame) hoặc (after_sequence, None)"""
+        with self.condition:
+            if self.sequence <= after_sequence and not self.exhausted.is_set():
+                self.condition.wait(timeout)
+            if self.sequence <= after_sequence:
+                return after_sequence, None
+            self.consumed_sequence = self.sequence
+            return self.sequence, self.frame
+
+def box_iou(box_a, box_b):
+    """IoU của hai box (top, right, bottom, left)"""
+    top, bottom = max(box_a[0], box_b[0]), min(box_a[2], box_b[2])
+    left, right = max(box_a[3], box_b[3]), min(box_a[1], box_b[1])
+    intersection = max(0, bottom - top) * max(0, right - left)
+    area_a = (box_a[2] - box_a[0]) * (box_a[1] - box_a[3])
+    area_b = (box_b[2] - box_b[0]) * (box_b[1] - box_b[3])
+    union = area_a + area_b - intersection
+    return intersection / float(union) if union > 0 else 0.0
+
+class FaceTrack:
+    """Một khuôn mặt đang được theo dõi qua các frame"""
+    def __init__(self, track_id, box, template):
+        self.track_id = track_id
+        self.box = box
+        self.template = template
+        self.encodings = []
+        self.evidence = []
+        self.identity = None
+        self.missed_detections = 0
+
+    def reset_identity(self):
+        """Quên danh tính khi mất dấu: vị trí này có thể đã là người khác"""
+        self.encodings = []
+        self.evidence = []
+        self.identity = None
+
+class FaceTracker:
+    """Theo dõi khuôn mặt qua các frame để không phải detect + encode lại mỗi chu kỳ.
+
+    Detect đầy đủ chỉ chạy mỗi detection_interval frame hoặc khi mất dấu; ở giữa, vị trí
+    khuôn mặt được cập nhật bằng template matching. Detection mới được ghép với track cũ
+    theo IoU: track đã nhận diện không cần encode lại, track chưa nhận diện được encode
+    và lấy trung bình encoding của nhiều frame gần nhất. Track bị mất dấu (template
+    không khớp hoặc lỡ một lần detect) mất danh tính và phải nhận diện lại.
+    """
+    def __init__(self, detection_interval=5, iou_threshold=0.3, template_threshold=0.6,
+                 max_missed_detections=1, max_track_encodings=5):
+        self.detection_interval = max(1, detection_interval)
+        self.iou_threshold = iou_threshold
+        self.template_threshold = template_threshold
+        self.max_missed_detections = max_missed_detections
+        self.max_track_encodings = max(1, max_track_encodings)
+        self.tracks = []
+        self.next_track_id = 1
+        self.frames_since_detection = 0
+        self.lost = False
+
+    def needs_detection(self):
+        return not self.tracks or self.lost or self.frames_since_detection >= self.detection_interval
+
+    def follow(self, gray_image):
+        """Cập nhật vị trí các track bằng template matching (không detect)"""
+        self.frames_since_detection += 1
+        for track in self.tracks:
+            box = self._match_template(track, gray_image)
+            if box is None:
+                self.lost = True
+                track.reset_identity()
+            else:
+                track.box = box
+
+    def update_detections(self, face_locations, gray_image):
+        """Ghép detection mới với các track, trả về các track cần encode"""
+        self.frames_since_detection = 0
+        self.lost = False
+        
+        pairs = sorted(
+            ((box_iou(track.box, location), track_index, location_index)
+             for track_index, track in enumerate(self.tracks)
+             for location_index, location in enumerate(face_locations)),
+            reverse=True
+        )
+        matched_tracks, matched_locations = set(), set()
+        for score, track_index, location_index in pairs:
+            if score < self.iou_threshold:
+                break
+            if track_index in matched_tracks or location_index in matched_locations:
+                continue
+            matched_tracks.add(track_index)
+            matched_locations.add(location_index)
+            track = self.tracks[track_index]
+            track.box = tuple(face_locations[location_index])
+            track.template = self._crop(gray_image, track.box)
+            track.missed_detections = 0
+        
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in matched_tracks:
+                track.missed_detections += 1
+                track.reset_identity()
+        self.tracks = [track for track in self.tracks if track.missed_detections <= self.max_missed_detections]
+        
+        for location_index, location in enumerate(face_locations):
+            if location_index not in matched_locations:
+                self.tracks.append(FaceTrack(self.next_track_id, tuple(location), self._crop(gray_image, location)))
+                self.next_track_id += 1
+        
+        return [track for track in self.tracks if track.identity is None and track.missed_detections == 0]
+
+    def add_encoding(self, track, encoding):
+        """Thêm encoding cho track, trả về encoding trung bình của các frame gần nhất"""
+        track.encodings.append(np.asarray(encoding, dtype=np.float32))
+        del track.encodings[:-self.max_track_encodings]
+        return np.mean(track.encodings, axis=0)
+
+    @staticmethod
+    def _crop(gray_image, box):
+        top, right, bottom, left = box
+        return gray_image[max(0, top):max(0, bottom), max(0, left):max(0, right)].copy()
+
+    def _match_template(self, track, gray_image):
+        """Tìm lại khuôn mặt quanh vị trí cũ, trả về box mới hoặc None nếu mất dấu"""
+        template_height, template_width = track.template.shape[:2]
+        if template_height < 8 or template_width < 8:
+            return None
+        top, right, bottom, left = track.box
+        margin_y, margin_x = template_height // 2, template_width // 2
+        y0, x0 = max(0, top - margin_y), max(0, left - margin_x)
+        y1, x1 = min(gray_image.shape[0], bottom + margin_y), min(gray_image.shape[1], right + margin_x)
+        window = gray_image[y0:y1, x0:x1]
+        if window.shape[0] < template_height or window.shape[1] < template_width:
+            return None
+        
+        scores = cv2.matchTemplate(window, track.template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (x, y) = cv2.minMaxLoc(scores)
+        if score < self.template_threshold:
+            return None
+        return (y0 + y, x0 + x + template_width, y0 + y + template_height, x0 + x)
+
+class IdentityDecision:
+    """Tích lũy bằng chứng nhận diện của một track trong cửa sổ thời gian trượt.
+
+    Mỗi lần encode track là một quan sát. Quan sát "ủng hộ" một nhân viên khi khớp
+    (trong tolerance/confidence_threshold) và cách người gần thứ nhì ít nhất
+    min_margin. Chấp nhận ngay khi khoảng cách đó đạt instant_accept_margin (hoặc
+    gallery chỉ có một người); ngược lại cần min_observations quan sát ủng hộ cùng
+    một người trong window_seconds và nhiều hơn số quan sát ủng hộ bất kỳ người khác.
+    """
+    def __init__(self, window_seconds=2.0, min_observations=2, min_margin=0.05, instant_accept_margin=0.2):
+        self.window_seconds = window_seconds
+        self.min_observations = max(1, min_observations)
+        self.min_margin = min_margin
+        self.instant_accept_margin = instant_accept_margin
+
+    def observe(self, track, face, now=None):
+        """Thêm một kết quả identify_faces cho track, trả về True nếu đủ bằng chứng"""
+        now = time.time() if now is None else now
+        margin = face.get("margin")
+        supporting = face["matched"] and (margin is None or margin >= self.min_margin)
+        track.evidence.append((now, face["employee_id"] if supporting else None))
+        track.evidence = [item for item in track.evidence if now - item[0] <= self.window_seconds]
+        if not supporting:
+            return False
+        if margin is None or margin >= self.instant_accept_margin:
+            return True
+        
+        votes = {}
+        for _, employee_id in track.evidence:
+            if employee_id is not None:
+                votes[employee_id] = votes.get(employee_id, 0) + 1
+        leader_votes = votes.pop(face["employee_id"])
+        return leader_votes >= self.min_observations and leader_votes > max(votes.values(), default=0)
+
+class CameraPipeline:
+    """Trạng thái nhận diện của một camera trong vòng lặp dùng chung.
+
+    Giữ grabber, tracker, bộ quyết định (IdentityDecision), bộ đếm frame và nhân
+    viên đã nhận diện của camera; việc detect/encode do run_camera_pipelines điều
+    phối trên worker pool chung.
+    fps_budget giới hạn số lần detect mỗi giây (0 = không giới hạn);
+    recognition_cooldown (giây) cho phép cùng một người được ghi nhận lại sau
+    khoảng thời gian này, None = chỉ một lần mỗi phiên.
+    """
+    def __init__(self, service, camera_id, frame_source, frame_scale, fps_budget=0, recognition_cooldown=None):
+        self.service = service
+        self.camera_id = camera_id
+        self.frame_source = frame_source
+        self.frame_scale = frame_scale
+        self.detection_interval = 1.0 / fps_budget if fps_budget else 0.0
+        self.recognition_cooldown = recognition_cooldown
+        self.tracker = service.create_tracker()
+        self.decision = service.create_decision()
+        self.grabber = LatestFrameGrabber(frame_source, metrics=service.metrics, stop_on_eof=frame_source.finite)
+        self.stats = {"frames_captured": 0, "frames_dropped_stale": 0, "frames_skipped": 0,
+                      "frames_dropped_busy": 0, "frames_processed": 0, "frames_tracked": 0, "faces_encoded": 0}
+        self.recognized_at = {}
+        self.in_flight = 0
+        self.last_sequence = 0
+        self.last_submitted_sequence = -service.process_every_nth_frame
+        self.last_detection_sequence = 0
+        self.next_detection_time = 0.0
+        self.started_at = None
+        self.last_face_at = None
+
+    def start(self, frame_event=None):
+        self.started_at = time.perf_counter()
+        self.last_face_at = self.started_at
+        self.grabber.frame_event = frame_event
+        self.grabber.start()
+
+    def stop(self):
+        if self.started_at is not None:
+            self.grabber.stop()
+            self.stats["frames_captured"] = self.grabber.frames_captured
+            self.stats["frames_dropped_stale"] = self.grabber.frames_dropped
+        self.frame_source.release()
+
+    @property
+    def finished(self):
+        """Nguồn hữu hạn đã hết frame và không còn job đang xử lý"""
+        return (self.grabber.exhausted.is_set() and self.in_flight == 0
+                and self.grabber.sequence <= self.last_sequence)
+
+    @property
+    def idle_seconds(self):
+        """Số giây liên tục không thấy khuôn mặt nào"""
+        return time.perf_counter() - self.last_face_at
+
+    def next_frame(self, can_submit):
+        """Lấy frame mới nhất; trả về (sequence, frame) nếu cần detect, ngược lại None.
+
+        Frame không cần detect vẫn được dùng để bám track, hoặc bị bỏ theo
+        process_every_nth_frame / fps_budget / worker bận.
+        """
+        sequence, frame = self.grabber.wait_for_frame(self.last_sequence, timeout=0)
+        if frame is None:
+            return None
+        self.last_sequence = sequence
+        
+        # Chỉ xử lý mỗi frame thứ N (performance.process_every_nth_frame), tính theo số frame camera
+        if sequence - self.last_submitted_sequence < self.service.process_every_nth_frame:
+            self.stats["frames_skipped"] += 1
+            return None
+        if not self.tracker.needs_detection():
+            # Giữa hai lần detect: chỉ bám theo khuôn mặt đã biết
+            self.last_submitted_sequence = sequence
+            self.stats["frames_tracked"] += 1
+            small_frame = self.service.prepare_frame(frame, self.frame_scale)
+            with self.service.metrics.span("tracking"):
+                self.tracker.follow(cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY))
+            if self.tracker.tracks:
+                self.last_face_at = time.perf_counter()
+            return None
+        now = time.perf_counter()
+        if now < self.next_detection_time:
+            self.stats["frames_skipped"] += 1
+            return None
+        if not can_submit:
+            # Hàng đợi worker đầy: bỏ frame thay vì xếp hàng frame cũ
+            self.stats["frames_dropped_busy"] += 1
+            return None
+        
+        self.last_submitted_sequence = sequence
+        self.next_detection_time = now + self.detection_interval
+        return sequence, frame
+
+    def handle_detection(self, sequence, gray_small_frame, face_locations):
+        """Cập nhật tracker theo kết quả detect, trả về các track cần encode"""
+        self.stats["frames_processed"] += 1
+        if len(face_locations) > 0:
+            self.last_face_at = time.perf_counter()
+        if sequence < self.last_detection_sequence:
+            return []  # Kết quả cũ hơn lần detect đã áp dụng
+        self.last_detection_sequence = sequence
+        
+        # Chỉ encode khuôn mặt mới hoặc chưa nhận diện được
+        tracks = self.tracker.update_detections(face_locations, gray_small_frame)
+        self.stats["faces_encoded"] += len(tracks)
+        return tracks
+
+    def handle_encodings(self, job, face_encodings):
+        """So khớp encoding trung bình của từng track với gallery, trả về các lượt nhận diện mới.
+
+        Mọi track của frame được so khớp trong một lần identify_faces (một phép nhân ma trận).
+        """
+        recognitions = []
+        tracks = job["tracks"][:len(face_encodings)]
+        if not tracks:
+            return recognitions
+        mean_encodings = [self.tracker.add_encoding(track, face_encoding)
+                          for track, face_encoding in zip(tracks, face_encodings)]
+        with self.service.metrics.span("matching"):
+            faces = self.service.identify_faces([track.box for track in tracks], mean_encodings, sort_by_distance=False)
+        for track, face in zip(tracks, faces):
+            if not self.decision.observe(track, face):
+                continue  # Chưa đủ bằng chứng, chờ thêm frame
+            
+            track.identity = face
+            if not self.should_report(face["employee_id"]):
+                continue
+            
+            recognitions.append({
+                "success": True,
+                "employee_id": face["employee_id"],
+                "employee_name": face["employee_name"],
+                "confidence": face["confidence"],
+                "timestamp": datetime.now().isoformat(),
+                "attendance_image": self.service.save_attendance_image(
+                    face["employee_id"], job["frame"], [int(v / self.frame_scale) for v in track.box], self.camera_id
+                )
+            })
+            self.service.metrics.record("time_to_match", (time.perf_counter() - self.started_at) * 1000.0)
+        return recognitions
+
+    def should_report(self, employee_id):
+        now = time.time()
+        last_time = self.recognized_at.get(employee_id)
+        if last_time is not None and (self.recognition_cooldown is None or now - last_time < self.recognition_cooldown):
+            return False
+        self.recognized_at[employee_id] = now
+        return True
+
+class AttendanceImageWriter:
+    """Ghi ảnh chấm công trên thread nền qua hàng đợi có giới hạn.
+
+    submit() trả về ngay đường dẫn sẽ ghi, nên kết quả chấm công không phải chờ
+    nén JPEG và ghi đĩa. Khi hàng đợi đầy, ảnh bị bỏ qua (có log) thay vì chặn
+    luồng nhận diện. close() ghi nốt các ảnh còn trong hàng đợi.
+    """
+    def __init__(self, folder, jpeg_quality=90, crop_face=False, crop_padding=0.4,
+                 shard_by_date=True, queue_size=16, metrics=None):
+        self.folder = folder
+        self.metrics = metrics
+        self.jpeg_quality = int(jpeg_quality)
+        self.crop_face = crop_face
+        self.crop_padding = crop_padding
+        self.shard_by_date = shard_by_date
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.images_written = 0
+        self.images_failed = 0
+        self.images_dropped = 0
+        self.thread = threading.Thread(target=self._run, name="attendance-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, employee_id, frame, face_box=None, camera_id=None):
+        """Xếp ảnh vào hàng đợi ghi, trả về đường dẫn dự kiến hoặc None nếu hàng đợi đầy.
+
+        camera_id (nhiều camera) được đưa vào tên file để hai camera nhận diện cùng
+        một người trong cùng một giây không ghi đè ảnh của nhau.
+        """
+        now = datetime.now()
+        folder = os.path.join(self.folder, now.strftime("%Y-%m-%d")) if self.shard_by_date else self.folder
+        camera_part = "" if camera_id is None else "_" + re.sub(r'[^A-Za-z0-9-]', '-', str(camera_id))
+        path = os.path.join(folder, f"{employee_id}{camera_part}_{now.strftime('%Y%m%d_%H%M%S')}.jpg")
+        
+        if self.crop_face and face_box is not None:
+            frame = self._crop(frame, face_box)
+        try:
+            self.queue.put_nowait((path, frame))
+        except queue.Full:
+            self.images_dropped += 1
+            if self.metrics is not None:
+                self.metrics.increment("images_dropped")
+            print(f"Attendance image queue full, dropped {path}", file=sys.stderr)
+            return None
+        return path
+
+    def close(self, timeout=10):
+        """Ghi nốt hàng đợi rồi dừng thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+    def _crop(self, frame, face_box):
+        top, right, bottom, left = face_box
+        pad_y = int((bottom - top) * self.crop_padding)
+        pad_x = int((right - left) * self.crop_padding)
+        height, width = frame.shape[:2]
+        return frame[max(0, top - pad_y):min(height, bottom + pad_y), max(0, left - pad_x):min(width, right + pad_x)]
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, frame = item
+            start = time.perf_counter()
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                success, encoded_image = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                if not success:
+                    raise IOError("không nén được JPEG")
+                with open(path, 'wb') as f:
+                    f.write(encoded_image.tobytes())
+                self.images_written += 1
+                if self.metrics is not None:
+                    self.metrics.record("image_save", (time.perf_counter() - start) * 1000.0)
+            except Exception as e:
+                self.images_failed += 1
+                if self.metrics is not None:
+                    self.metrics.increment("images_save_failed")
+                print(f"Error saving attendance image {path}: {str(e)}", file=sys.stderr)
+
 class FaceRecognitionService:
     def __init__(self, config_path="config.json"):
         self.config = self.load_config(config_path)
+        
+        # Log JSON + metrics theo mục "logging"
+        logging_config = self.config.get("logging", {})
+        configure_logging(logging_config)
+        self.metrics = ServiceMetrics(
+            logging_config.get("metrics_file", "face_recognition_metrics.json"),
+            logging_config.get("max_metric_samples", 5000)
+        )
         self.faces_folder = self.config.get("faces_folder", "faces")
         self.tolerance = self.config.get("tolerance", 0.6)
         self.confidence_threshold = self.config.get("confidence_threshold", 0.4)
         
-        self.known_face_encodings = []
-        self.known_face_names = []
-        self.known_employee_ids = []
+        # Các tham số hiệu năng (config.json "performance")
+        self.performance = self.config.get("performance", {})
+        self.process_every_nth_frame = max(1, int(self.performance.get("process_every_nth_frame", 2)))
+        self.detection_model = self.performance.get("face_detection_model", "hog")
+        self.upsample_times = self.performance.get("number_of_times_to_upsample", 1)
+        default_jitters = self.performance.get("num_jitters", 1)
+        self.registration_num_jitters = self.performance.get("registration_num_jitters", default_jitters)
+        self.recognition_num_jitters = self.performance.get("recognition_num_jitters", default_jitters)
+        self.max_image_dimension = self.performance.get("max_image_dimension", 1280)
+        
+        # So khớp theo template nhân viên (config.json "matching")
+        self.matching = self.config.get("matching", {})
+        self.use_templates = self.matching.get("templates", True)
+        self.template_candidates = max(1, int(self.matching.get("template_candidates", 5)))
+        self.min_face_quality = self.matching.get("min_face_quality", 0.0)
+        
+        self.attendance_writer = None
+        self.reset_gallery()
         
         # Tạo thư mục faces nếu chưa có
         if not os.path.exists(self.faces_folder):
             os.makedirs(self.faces_folder)
             
-        self.load_known_faces()
+        self.encoding_store = FaceEncodingStore(
+            self.config.get("encoding_cache_folder") or os.path.join(self.faces_folder, ".encodings"),
+            encoder_settings={
+                "face_detection_model": self.detection_model,
+                "number_of_times_to_upsample": self.upsample_times,
+                "num_jitters": self.registration_num_jitters,
+                "max_image_dimension": self.max_image_dimension,
+                "quality_scoring": 1
+            }
+        )
+
+        with self.metrics.span("load_known_faces"):
+            self.load_known_faces()
     
     def load_config(self, config_path):
         """Load cấu hình từ file JSON"""
@@ -78,48 +1688,298 @@ class FaceRecognitionService:
                 pass  # Ignore if can't create config file
             return default_config
     
+    def reset_gallery(self):
+        """Xóa toàn bộ gallery trong bộ nhớ"""
+        self.gallery = FaceGallery(templates=self.use_templates)
+        self.cache_entries = {}
+
+    def build_search_index(self):
+        """Gắn index IVF cho gallery nếu config "matching.index" = "ivf".
+
+        Centroid được lưu trong cache và chỉ train lại khi gallery đã lớn gấp
+        ivf_retrain_growth lần so với lúc train; đăng ký/xóa sau đó cập nhật index tăng dần.
+        Khi so khớp theo template, index được dựng trên các template nhân viên.
+        """
+        matching = self.matching
+        if matching.get("index", "linear") != "ivf":
+            return
+        
+        gallery = self.gallery.templates if self.gallery.templates is not None else self.gallery
+        min_size = matching.get("ivf_min_gallery_size", 1000)
+        if len(gallery) == 0 or len(gallery) < min_size:
+            # Gallery rỗng không train được centroid
+            return
+        
+        index = IVFIndex(nlist=matching.get("ivf_nlist", 0), nprobe=matching.get("ivf_nprobe", 8))
+        centroids, trained_size = self.encoding_store.load_ivf_centroids()
+        if centroids is not None and len(gallery) <= trained_size * matching.get("ivf_retrain_growth", 2):
+            index.centroids = centroids
+        else:
+            index.train(gallery.encodings)
+            try:
+                self.encoding_store.save_ivf_centroids(index.centroids, len(gallery))
+            except Exception as e:
+                print(f"Error saving IVF index: {str(e)}", file=sys.stderr)
+        
+        gallery.attach_index(index, min_size)
+
     def load_known_faces(self):
-        """Load tất cả khuôn mặt đã đăng ký từ thư mục faces"""
-        self.known_face_encodings = []
-        self.known_face_names = []
-        self.known_employee_ids = []
+        """Load tất cả khuôn mặt đã đăng ký từ thư mục faces.
+
+        Encoding được lấy từ cache trên đĩa; chỉ ảnh mới hoặc đã thay đổi
+        (khác mtime/kích thước và khác SHA-1) mới phải encode lại.
+        """
+        self.reset_gallery()
         
         if not os.path.exists(self.faces_folder):
             return
-        
-        for filename in os.listdir(self.faces_folder):
-            if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp')):
-                try:
-                    name_part = filename.split('.')[0]
-                    parts = name_part.split('_', 1)
-                    
-                    if len(parts) >= 2:
-                        employee_id = parts[0]
-                        employee_name = parts[1].replace('_', ' ')
-                    else:
-                        employee_id = name_part
-                        employee_name = name_part
-                    
-                    image_path = os.path.join(self.faces_folder, filename)
-                    
-                    # Load image with error handling
+
+        cached_entries, cached_matrix = self.encoding_store.load()
+        cached_by_file = {entry["file"]: entry for entry in cached_entries}
+        cached_by_hash = {entry["sha1"]: entry for entry in cached_entries if entry.get("sha1")}
+
+        encoded_count = 0
+        cached_count = 0
+        unreadable_count = 0
+        dirty = self.encoding_store.journal_length > 0
+
+        for filename in sorted(os.listdir(self.faces_folder)):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            try:
+                employee_id, employee_name = self.parse_face_filename(filename)
+                image_path = os.path.join(self.faces_folder, filename)
+                stat = os.stat(image_path)
+
+                cached = cached_by_file.get(filename)
+                if cached is not None and cached.get("mtime_ns") == stat.st_mtime_ns and cached.get("size") == stat.st_size:
+                    digest = cached["sha1"]
+                else:
+                    # File mới hoặc mtime đổi: so nội dung để tránh encode lại khi chỉ bị touch/đổi tên
+                    digest = file_sha1(image_path)
+                    cached = cached_by_hash.get(digest)
+                    dirty = True
+
+                if cached is not None and cached.get("sha1") == digest:
+                    row = cached.get("row")
+                    encoding = None if row is None else np.array(cached_matrix[row], dtype=np.float32)
+                    quality = cached.get("quality", 1.0)
+                    cached_count += 1
+                else:
                     try:
-                        image = face_recognition.load_image_file(image_path)
+                        image = limit_image_size(face_recognition.load_image_file(image_path), self.max_image_dimension)
                     except Exception as e:
+                        # Ghi entry rỗng như ảnh không có mặt để lần khởi động sau không đọc lại file hỏng
                         print(f"Error loading image {filename}: {str(e)}", file=sys.stderr)
-                        continue
-                    
-                    face_encodings = face_recognition.face_encodings(image)
-                    if len(face_encodings) > 0:
-                        self.known_face_encodings.append(face_encodings[0])
-                        self.known_face_names.append(employee_name)
-                        self.known_employee_ids.append(employee_id)
-                        
-                except Exception as e:
-                    print(f"Error processing {filename}: {str(e)}", file=sys.stderr)
-                    continue
+                        image = None
+
+                    if image is None:
+                        encoding, quality = None, None
+                        unreadable_count += 1
+                    else:
+                        face_locations, face_encodings = self.detect_and_encode(image, self.registration_num_jitters)
+                        encoding = np.asarray(face_encodings[0], dtype=np.float32) if len(face_encodings) > 0 else None
+                        quality = face_quality(image, face_locations[0])["score"] if len(face_encodings) > 0 else None
+                        encoded_count += 1
+
+                self.cache_entries[filename] = self.make_cache_entry(filename, stat, digest, employee_id, employee_name, quality)
+                if encoding is not None:
+                    self.gallery.add(filename, employee_id, employee_name, encoding, 1.0 if quality is None else quality)
+
+            except Exception as e:
+                print(f"Error processing {filename}: {str(e)}", file=sys.stderr)
+                continue
+
+        # Giải phóng memmap trước khi ghi đè cache (Windows không cho xóa file đang mmap)
+        del cached_matrix
+
+        if dirty or len(self.cache_entries) != len(cached_entries):
+            try:
+                self.save_encoding_cache()
+            except Exception as e:
+                print(f"Error saving encoding cache: {str(e)}", file=sys.stderr)
+
+        self.build_search_index()
+
+        print(f"Loaded {len(self.gallery)} known faces ({encoded_count} encoded, "
+              f"{cached_count} from cache, {unreadable_count} unreadable)", file=sys.stderr)
+        logger.info("faces_loaded", extra={"fields": {
+            "known_faces": len(self.gallery), "encoded": encoded_count,
+            "from_cache": cached_count, "unreadable": unreadable_count
+        }})
+
+    def make_cache_entry(self, filename, stat, digest, employee_id, employee_name, quality=None):
+        """Tạo entry cache cho một file ảnh khuôn mặt"""
+        return {
+            "file": filename,
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha1": digest,
+            "employee_id": employee_id,
+            "employee_name": employee_name,
+            "quality": quality
+        }
+
+    def save_encoding_cache(self):
+        """Ghi toàn bộ gallery hiện tại xuống cache (compact journal)"""
+        entries = []
+        for filename, entry in self.cache_entries.items():
+            entry = dict(entry)
+            entry["row"] = self.gallery.file_rows.get(filename)
+            entries.append(entry)
+        
+        self.encoding_store.save(entries, self.gallery.encodings)
+
+    def journal_gallery_change(self, record):
+        """Ghi thay đổi gallery vào journal, compact khi journal quá dài"""
+        try:
+            self.encoding_store.append_journal(record)
+            if self.encoding_store.journal_length >= self.encoding_store.MAX_JOURNAL_LENGTH:
+                self.save_encoding_cache()
+        except Exception as e:
+            # Cache chỉ là bản sao của thư mục faces, lần load sau sẽ tự đồng bộ lại
+            print(f"Error updating encoding cache: {str(e)}", file=sys.stderr)
+
+    def detect_and_encode(self, rgb_image, num_jitters):
+        """Phát hiện khuôn mặt và tính encoding theo cấu hình performance"""
+        return detect_and_encode_image(rgb_image, **self.encoder_settings(num_jitters))
+
+    def encoder_settings(self, num_jitters):
+        """Tham số detect/encode để truyền sang worker process"""
+        return {"model": self.detection_model, "upsample": self.upsample_times, "num_jitters": num_jitters}
+
+    def identify_faces(self, face_locations, face_encodings, sort_by_distance=True):
+        """So khớp các khuôn mặt với gallery, trả về danh sách sắp theo khoảng cách tăng dần
+        (sort_by_distance=False giữ thứ tự đầu vào)"""
+        faces = []
+        rows, distances = self.gallery.match_identities(face_encodings, self.template_candidates, k=2)
+        for face_index in range(len(face_encodings)):
+            face = {"location": [int(v) for v in face_locations[face_index]], "matched": False}
+            if distances.shape[1] > 0 and rows[face_index, 0] >= 0:
+                row = rows[face_index, 0]
+                distance = float(distances[face_index, 0])
+                confidence = 1 - distance
+                # Khoảng cách tới nhân viên gần thứ nhì; None khi gallery chỉ có một người
+                margin = None
+                if distances.shape[1] > 1 and rows[face_index, 1] >= 0:
+                    margin = round(float(distances[face_index, 1]) - distance, 4)
+                face.update({
+                    "employee_id": self.gallery.employee_ids[row],
+                    "employee_name": self.gallery.employee_names[row],
+                    "distance": round(distance, 4),
+                    "confidence": round(confidence * 100, 2),
+                    "margin": margin,
+                    "matched": distance < self.tolerance and confidence > self.confidence_threshold
+                })
+            faces.append(face)
+        if sort_by_distance:
+            faces.sort(key=lambda face: face.get("distance", float("inf")))
+        return faces
+
+    def map_encode_images(self, image_paths, num_jitters, with_quality=False):
+        """Decode + encode nhiều file ảnh song song trên process pool, giữ đúng thứ tự đầu vào.
+
+        Worker chỉ làm phần nặng (decode, detect, encode); so khớp gallery chạy ở
+        process chính nên gallery không phải copy sang worker.
+        """
+        worker = functools.partial(encode_image_file, settings=self.encoder_settings(num_jitters),
+                                   max_dimension=self.max_image_dimension, with_quality=with_quality)
+        worker_count = int(self.performance.get("batch_workers") or os.cpu_count() or 1)
+        worker_count = min(worker_count, len(image_paths))
+        
+        if worker_count <= 1:
+            for image_path in image_paths:
+                yield worker(image_path)
+            return
+        
+        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+            chunksize = max(1, min(16, len(image_paths) // (worker_count * 4)))
+            for result in executor.map(worker, image_paths, chunksize=chunksize):
+                yield result
+
+    def build_image_result(self, encoded):
+        """Tạo dict kết quả nhận diện cho một ảnh đã encode"""
+        result = {"image": encoded.get("image")}
+        if encoded.get("error"):
+            result.update({"success": False, "message": f"Không thể đọc file ảnh: {encoded['error']}"})
+            return result
         
-        print(f"Loaded {len(self.known_face_encodings)} known faces", file=sys.stderr)
+        faces = self.identify_faces(encoded["face_locations"], encoded["encodings"])
+        best_face = next((face for face in faces if face["matched"]), None)
+        if best_face is not None:
+            result.update({
+                "success": True,
+                "employee_id": best_face["employee_id"],
+                "employee_name": best_face["employee_name"],
+                "confidence": best_face["confidence"],
+                "timestamp": datetime.now().isoformat()
+            })
+        elif len(faces) == 0:
+            result.update({"success": False, "message": "Không tìm thấy khuôn mặt trong ảnh"})
+        else:
+            result.update({"success": False, "message": "Không nhận diện được khuôn mặt"})
+        result["faces"] = faces
+        return result
+
+    def load_input_image(self, image_input):
+        """Đọc ảnh đầu vào (đường dẫn file, chuỗi data:image base64 hoặc bytes thô) thành mảng RGB.
+
+        Ảnh được giải mã trực tiếp trong bộ nhớ, không qua file tạm, và được thu nhỏ
+        theo performance.max_image_dimension. Trả về (image, None) hoặc (None, dict lỗi).
+        """
+        if isinstance(image_input, (bytes, bytearray)):
+            try:
+                image = decode_image_bytes(image_input)
+            except Exception as e:
+                return None, {"success": False, "message": f"Lỗi xử lý dữ liệu ảnh: {str(e)}"}
+        elif isinstance(image_input, str) and image_input.startswith('data:image'):
+            try:
+                image = decode_base64_image(image_input)
+            except Exception as e:
+                return None, {"success": False, "message": f"Lỗi xử lý ảnh base64: {str(e)}"}
+        else:
+            # File path - đảm bảo encoding đúng
+            if not image_input or not os.path.isfile(image_input):
+                return None, {"success": False, "message": f"File không tồn tại: {image_input}"}
+            try:
+                image = face_recognition.load_image_file(image_input)
+            except Exception as e:
+                return None, {"success": False, "message": f"Không thể đọc file ảnh: {str(e)}"}
+        
+        return limit_image_size(image, self.max_image_dimension), None
+
+    def recognize_image(self, image_input):
+        """Nhận diện khuôn mặt từ một file ảnh, chuỗi base64 (data:image) hoặc bytes ảnh"""
+        try:
+            image, error = self.load_input_image(image_input)
+            if error is not None:
+                return error
+            
+            face_locations, face_encodings = self.detect_and_encode(image, self.recognition_num_jitters)
+            return self.build_image_result({
+                "image": image_input if isinstance(image_input, str) and not image_input.startswith('data:image') else None,
+                "face_locations": face_locations,
+                "encodings": face_encodings
+            })
+        except Exception as e:
+            return {"success": False, "message": f"Lỗi hệ thống: {str(e)}"}
+
+    def recognize_images(self, image_paths):
+        """Nhận diện hàng loạt ảnh, yield từng kết quả theo thứ tự đầu vào"""
+        for encoded in self.map_encode_images(list(image_paths), self.recognition_num_jitters):
+            try:
+                yield self.build_image_result(encoded)
+            except Exception as e:
+                yield {"success": False, "image": encoded.get("image"), "message": f"Lỗi hệ thống: {str(e)}"}
+
+    def parse_face_filename(self, filename):
+        """Tách employee_id và tên nhân viên từ tên file {employee_id}_{name}.jpg"""
+        name_part = filename.split('.')[0]
+        parts = name_part.split('_', 1)
+        
+        if len(parts) >= 2:
+            return parts[0], parts[1].replace('_', ' ')
+        return name_part, name_part
     
     def sanitize_filename(self, filename):
         """Tạo tên file an toàn từ tên tiếng Việt"""
@@ -150,7 +2010,7 @@ class FaceRecognitionService:
         
         return filename[:50]  # Giới hạn độ dài
 
-    def register_face_with_timeout(self, employee_id, employee_name, image_path, timeout_seconds=60):
+    def register_face_with_timeout(self, employee_id, employee_name, image_path, timeout_seconds=60, additional=False):
         """Đăng ký khuôn mặt với timeout"""
         def timeout_handler(signum, frame):
             raise TimeoutException("Registration timeout")
@@ -161,7 +2021,7 @@ class FaceRecognitionService:
             signal.alarm(timeout_seconds)
         
         try:
-            result = self.register_face(employee_id, employee_name, image_path)
+            result = self.register_face(employee_id, employee_name, image_path, additional)
             return result
         except TimeoutException:
             return {"success": False, "message": "Đăng ký hết thời gian chờ"}
@@ -169,46 +2029,24 @@ class FaceRecognitionService:
             if hasattr(signal, 'SIGALRM'):
                 signal.alarm(0)  # Cancel timeout
 
-    def register_face(self, employee_id, employee_name, image_path_or_base64):
-        """Đăng ký khuôn mặt mới"""
+    def register_face(self, employee_id, employee_name, image_path_or_base64, additional=False):
+        """Đăng ký khuôn mặt mới (ảnh là đường dẫn file, chuỗi data:image base64 hoặc bytes).
+
+        additional=True thêm một ảnh nữa cho nhân viên ({employee_id}_{tên}.{n}.jpg)
+        thay vì ghi đè ảnh chính.
+        """
         try:
             # Sanitize tên nhân viên để tránh lỗi encoding
             safe_employee_name = self.sanitize_filename(employee_name)
             
-            # Xử lý input image
-            if isinstance(image_path_or_base64, str) and image_path_or_base64.startswith('data:image'):
-                # Base64 image
-                try:
-                    image_data = image_path_or_base64.split(',')[1]
-                    image_bytes = base64.b64decode(image_data)
-                    
-                    temp_path = f"temp_{employee_id}_{int(time.time())}.jpg"
-                    with open(temp_path, 'wb') as f:
-                        f.write(image_bytes)
-                    
-                    image = face_recognition.load_image_file(temp_path)
-                    
-                    # Clean up temp file
-                    try:
-                        os.remove(temp_path)
-                    except:
-                        pass
-                        
-                except Exception as e:
-                    return {"success": False, "message": f"Lỗi xử lý ảnh base64: {str(e)}"}
-            else:
-                # File path - đảm bảo encoding đúng
-                if not os.path.exists(image_path_or_base64):
-                    return {"success": False, "message": f"File không tồn tại: {image_path_or_base64}"}
-                
-                try:
-                    image = face_recognition.load_image_file(image_path_or_base64)
-                except Exception as e:
-                    return {"success": False, "message": f"Không thể đọc file ảnh: {str(e)}"}
+            # Xử lý input image (file, base64 hoặc bytes) trực tiếp trong bộ nhớ
+            image, error = self.load_input_image(image_path_or_base64)
+            if error is not None:
+                return error
             
             # Tìm encoding khuôn mặt
             try:
-                face_encodings = face_recognition.face_encodings(image)
+                face_locations, face_encodings = self.detect_and_encode(image, self.registration_num_jitters)
             except Exception as e:
                 return {"success": False, "message": f"Lỗi phân tích khuôn mặt: {str(e)}"}
             
@@ -218,165 +2056,674 @@ class FaceRecognitionService:
             if len(face_encodings) > 1:
                 return {"success": False, "message": "Phát hiện nhiều khuôn mặt, vui lòng chọn ảnh có 1 khuôn mặt"}
             
+            quality = face_quality(image, face_locations[0])
+            if quality["score"] < self.min_face_quality:
+                return {
+                    "success": False,
+                    "message": "Chất lượng ảnh khuôn mặt quá thấp (mặt nhỏ, mờ hoặc nghiêng), vui lòng chụp lại",
+                    "quality": quality
+                }
+            
             # Kiểm tra trùng lặp
-            if len(self.known_face_encodings) > 0:
-                face_distances = face_recognition.face_distance(self.known_face_encodings, face_encodings[0])
-                min_distance = np.min(face_distances)
-                
-                if min_distance < self.tolerance:
-                    min_index = np.argmin(face_distances)
-                    existing_employee = self.known_employee_ids[min_index]
-                    
-                    if existing_employee != employee_id:
-                        return {
-                            "success": False, 
-                            "message": f"Khuôn mặt đã được đăng ký cho nhân viên khác: {existing_employee}"
-                        }
+            existing_employee = self.find_duplicate_employee(face_encodings[0], employee_id)
+            if existing_employee is not None:
+                return {
+                    "success": False, 
+                    "message": f"Khuôn mặt đã được đăng ký cho nhân viên khác: {existing_employee}"
+                }
+            
+            try:
+                # Chuyển từ RGB sang BGR cho OpenCV
+                image_bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+                success, encoded_image = cv2.imencode('.jpg', image_bgr)
+                if not success:
+                    return {"success": False, "message": "Không thể lưu file ảnh"}
+                image_bytes = encoded_image.tobytes()
+            except Exception as e:
+                return {"success": False, "message": f"Lỗi lưu ảnh: {str(e)}"}
             
             # Lưu ảnh khuôn mặt với tên file an toàn
-            face_filename = f"{employee_id}_{safe_employee_name}.jpg"
+            if additional:
+                same_photo = self.find_same_photo(employee_id, face_encodings[0], hashlib.sha1(image_bytes).hexdigest())
+                if same_photo is not None:
+                    return self.same_photo_result(employee_id, same_photo, quality)
+                face_filename = self.next_face_filename(employee_id, safe_employee_name)
+            else:
+                face_filename = f"{employee_id}_{safe_employee_name}.jpg"
             face_path = os.path.join(self.faces_folder, face_filename)
             
             try:
-                # Chuyển từ RGB sang BGR cho OpenCV
-                image_bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-                
                 # Ensure faces folder exists
                 os.makedirs(self.faces_folder, exist_ok=True)
-                
-                success = cv2.imwrite(face_path, image_bgr)
-                if not success:
-                    return {"success": False, "message": "Không thể lưu file ảnh"}
-                    
+                self.write_face_file(face_path, image_bytes)
             except Exception as e:
                 return {"success": False, "message": f"Lỗi lưu ảnh: {str(e)}"}
             
-            # Reload known faces
+            # Cập nhật gallery với encoding vừa tính, không cần load lại toàn bộ thư mục faces
             try:
-                self.load_known_faces()
+                entry, encoding = self.add_registered_face(face_filename, employee_id, face_encodings[0], quality["score"])
+                self.journal_gallery_change({"op": "add", "entry": entry, "encoding": encoding.tolist()})
             except Exception as e:
-                return {"success": False, "message": f"Lỗi tải lại dữ liệu: {str(e)}"}
+                return {"success": False, "message": f"Lỗi cập nhật dữ liệu: {str(e)}"}
             
             return {
                 "success": True, 
                 "message": "Đăng ký khuôn mặt thành công",
-                "face_path": face_path
+                "face_path": face_path,
+                "quality": quality,
+                "photo_count": len(self.gallery.employee_rows.get(employee_id, ()))
             }
             
         except Exception as e:
             return {"success": False, "message": f"Lỗi hệ thống: {str(e)}"}
 
-    def recognize_face_from_camera(self, timeout=30):
-        """Nhận diện khuôn mặt từ camera với timeout cải tiến"""
-        cap = None
+    def find_duplicate_employee(self, encoding, employee_id, gallery=None):
+        """Trả về employee_id khác đã có khuôn mặt trùng (trong tolerance), hoặc None"""
+        gallery = self.gallery if gallery is None else gallery
+        if len(gallery) == 0:
+            return None
+        rows, distances = gallery.match(encoding, k=1)
+        if rows[0, 0] >= 0 and distances[0, 0] < self.tolerance:
+            existing_employee = gallery.employee_ids[rows[0, 0]]
+            if existing_employee != employee_id:
+                return existing_employee
+        return None
+
+    def find_same_photo(self, employee_id, encoding, digest, gallery=None):
+        """Tên file ảnh đã lưu của chính nhân viên trùng ảnh mới (cùng SHA-1 hoặc
+        encoding gần như trùng), hoặc None.
+
+        Tránh lưu lại cùng một ảnh dưới tên .N mới khi chạy lại manifest hay đăng ký
+        --additional lặp lại.
+        """
+        gallery = self.gallery if gallery is None else gallery
+        rows = sorted(gallery.employee_rows.get(employee_id, ()))
+        if gallery is self.gallery:
+            for row in rows:
+                entry = self.cache_entries.get(gallery.files[row])
+                if entry is not None and entry.get("sha1") == digest:
+                    return gallery.files[row]
+        if not rows:
+            return None
+        distances = np.linalg.norm(gallery.encodings[rows] - np.asarray(encoding, dtype=np.float32), axis=1)
+        best = int(np.argmin(distances))
+        if distances[best] <= SAME_PHOTO_DISTANCE:
+            return gallery.files[rows[best]]
+        return None
+
+    def same_photo_result(self, employee_id, face_filename, quality):
+        """Kết quả đăng ký khi ảnh đã có sẵn cho nhân viên (không ghi thêm file)"""
+        return {
+            "success": True,
+            "message": "Ảnh này đã được đăng ký cho nhân viên, bỏ qua",
+            "face_path": os.path.join(self.faces_folder, face_filename),
+            "quality": quality,
+            "skipped": True,
+            "photo_count": len(self.gallery.employee_rows.get(employee_id, ()))
+        }
+
+    def write_face_file(self, face_path, image_bytes):
+        """Ghi file tạm rồi os.replace để không bao giờ để lại ảnh ghi dở trong thư mục faces"""
+        temp_face_path = f"{face_path}.{uuid.uuid4().hex}.tmp"
         try:
-            cap = cv2.VideoCapture(self.config.get("camera_index", 0))
-            
-            if not cap.isOpened():
+            with open(temp_face_path, 'wb') as f:
+                f.write(image_bytes)
+            os.replace(temp_face_path, face_path)
+        finally:
+            if os.path.exists(temp_face_path):
+                os.remove(temp_face_path)
+
+    def next_face_filename(self, employee_id, safe_employee_name, reserved=()):
+        """Tên file cho ảnh tiếp theo của nhân viên: ảnh chính rồi đến .2, .3, ...
+
+        reserved: các tên đã dành cho ảnh chưa ghi xuống đĩa (cùng lô đăng ký).
+        """
+        face_filename = f"{employee_id}_{safe_employee_name}.jpg"
+        number = 1
+        while face_filename in reserved or os.path.exists(os.path.join(self.faces_folder, face_filename)):
+            number += 1
+            face_filename = f"{employee_id}_{safe_employee_name}.{number}.jpg"
+        return face_filename
+
+    def add_registered_face(self, face_filename, employee_id, encoding, quality=1.0):
+        """Thêm file ảnh vừa lưu vào gallery và cache entries, trả về (entry, encoding)"""
+        face_path = os.path.join(self.faces_folder, face_filename)
+        encoding = np.asarray(encoding, dtype=np.float32)
+        entry = self.make_cache_entry(face_filename, os.stat(face_path), file_sha1(face_path),
+                                      employee_id, self.parse_face_filename(face_filename)[1], quality)
+        self.cache_entries[face_filename] = entry
+        self.gallery.add(face_filename, employee_id, entry["employee_name"], encoding, quality)
+        return entry, encoding
+
+    def register_faces_bulk(self, manifest_path):
+        """Đăng ký hàng loạt từ manifest CSV/JSONL (employee_id, employee_name, image_path).
+
+        Ảnh được encode song song trên process pool, kiểm tra trùng với gallery và
+        với các dòng khác trong cùng lô. Ảnh hợp lệ được ghi ra file tạm; chỉ khi đã
+        xử lý hết các dòng mới đồng loạt đưa vào thư mục faces, cập nhật gallery và
+        cache encoding một lần. Lỗi ở bước này khôi phục lại ảnh cũ và không dòng nào
+        được tính là đăng ký thành công.
+        Nhiều dòng cùng employee_id là nhiều ảnh của cùng một người: dòng đầu thay
+        ảnh chính, các dòng sau được thêm thành ảnh phụ.
+        """
+        try:
+            rows = load_registration_manifest(manifest_path)
+        except Exception as e:
+            return {"success": False, "message": f"Không thể đọc manifest: {str(e)}"}
+        
+        results = []
+        pending_rows = []
+        for row_number, row in enumerate(rows, start=1):
+            result = {"row": row_number, "employee_id": row.get("employee_id"), "success": False}
+            results.append(result)
+            if not row.get("employee_id") or not row.get("employee_name") or not row.get("image_path"):
+                result["message"] = "Thiếu tham số bắt buộc: employee_id, employee_name, image_path"
+            elif not os.path.isfile(row["image_path"]):
+                result["message"] = f"File không tồn tại: {row['image_path']}"
+            else:
+                pending_rows.append((row, result))
+        
+        image_paths = [row["image_path"] for row, _ in pending_rows]
+        batch_gallery = FaceGallery()
+        registered = []
+        reserved_filenames = set()
+        batch_digests = {}
+        batch_same_photos = []
+        written_employee_ids = set()
+        os.makedirs(self.faces_folder, exist_ok=True)
+        
+        encoded_images = self.map_encode_images(image_paths, self.registration_num_jitters, with_quality=True)
+        for (row, result), encoded in zip(pending_rows, encoded_images):
+            try:
+                employee_id = row["employee_id"]
+                if encoded.get("error"):
+                    result["message"] = f"Không thể đọc file ảnh: {encoded['error']}"
+                    continue
+                if len(encoded["encodings"]) == 0:
+                    result["message"] = "Không tìm thấy khuôn mặt trong ảnh"
+                    continue
+                if len(encoded["encodings"]) > 1:
+                    result["message"] = "Phát hiện nhiều khuôn mặt, vui lòng chọn ảnh có 1 khuôn mặt"
+                    continue
+                
+                encoding = encoded["encodings"][0]
+                quality = encoded["qualities"][0]
+                if quality["score"] < self.min_face_quality:
+                    result.update({
+                        "message": "Chất lượng ảnh khuôn mặt quá thấp (mặt nhỏ, mờ hoặc nghiêng), vui lòng chụp lại",
+                        "quality": quality
+                    })
+                    continue
+                
+                existing_employee = self.find_duplicate_employee(encoding, employee_id)
+                if existing_employee is None:
+                    existing_employee = self.find_duplicate_employee(encoding, employee_id, batch_gallery)
+                if existing_employee is not None:
+                    result["message"] = f"Khuôn mặt đã được đăng ký cho nhân viên khác: {existing_employee}"
+                    continue
+                
+                if row["image_path"].lower().endswith(('.jpg', '.jpeg')):
+                    # Ảnh JPEG được copy nguyên bản, không decode/encode lại
+                    with open(row["image_path"], 'rb') as f:
+                        image_bytes = f.read()
+                else:
+                    success, encoded_image = cv2.imencode('.jpg', cv2.imread(row["image_path"]))
+                    if not success:
+                        result["message"] = "Không thể lưu file ảnh"
+                        continue
+                    image_bytes = encoded_image.tobytes()
+                
+                # Ảnh đã lưu cho chính nhân viên này (chạy lại manifest) thì không ghi thêm bản .N
+                digest = hashlib.sha1(image_bytes).hexdigest()
+                same_photo = self.find_same_photo(employee_id, encoding, digest)
+                if same_photo is None:
+                    same_photo = batch_digests.get((employee_id, digest))
+                    if same_photo is None:
+                        same_photo = self.find_same_photo(employee_id, encoding, digest, batch_gallery)
+                    if same_photo is not None:
+                        # Trùng một dòng trước trong lô: chỉ thành công nếu lô được commit
+                        batch_same_photos.append((result, employee_id, same_photo, quality))
+                        written_employee_ids.add(employee_id)
+                        continue
+                if same_photo is not None:
+                    result.update(self.same_photo_result(employee_id, same_photo, quality))
+                    written_employee_ids.add(employee_id)
+                    continue
+                
+                safe_employee_name = self.sanitize_filename(row['employee_name'])
+                if employee_id in written_employee_ids:
+                    face_filename = self.next_face_filename(employee_id, safe_employee_name, reserved_filenames)
+                else:
+                    face_filename = f"{employee_id}_{safe_employee_name}.jpg"
+                face_path = os.path.join(self.faces_folder, face_filename)
+                
+                # Chỉ ghi file tạm; ảnh vào thư mục faces ở bước commit bên dưới
+                staged_path = f"{face_path}.{uuid.uuid4().hex}.tmp"
+                registered.append({"file": face_filename, "staged": staged_path, "employee_id": employee_id,
+                                   "encoding": encoding, "quality": quality["score"], "result": result})
+                with open(staged_path, 'wb') as f:
+                    f.write(image_bytes)
+                reserved_filenames.add(face_filename)
+                batch_digests[(employee_id, digest)] = face_filename
+                written_employee_ids.add(employee_id)
+                
+                batch_gallery.add(face_filename, employee_id, row["employee_name"], encoding)
+                result.update({"face_path": face_path, "quality": quality})
+            except Exception as e:
+                result["message"] = f"Lỗi hệ thống: {str(e)}"
+        # Dòng lỗi sau khi đã mở file tạm (vd. ghi lỗi) vẫn phải được dọn file tạm
+        staged_items = registered
+        registered = [item for item in staged_items if "message" not in item["result"]]
+        
+        # Một lần commit duy nhất cho cả lô
+        replaced = []  # (face_path, đường dẫn backup ảnh cũ hoặc None)
+        committed = False
+        try:
+            for item in registered:
+                face_path = os.path.join(self.faces_folder, item["file"])
+                backup_path = None
+                if os.path.exists(face_path):
+                    backup_path = f"{face_path}.{uuid.uuid4().hex}.bak"
+                    os.replace(face_path, backup_path)
+                replaced.append((face_path, backup_path))
+                os.replace(item["staged"], face_path)
+            for item in registered:
+                self.add_registered_face(item["file"], item["employee_id"], item["encoding"], item["quality"])
+            if registered:
+                self.save_encoding_cache()
+            committed = True
+        except Exception as e:
+            # Khôi phục thư mục faces như trước lô rồi đồng bộ lại gallery từ đĩa
+            for face_path, backup_path in reversed(replaced):
+                try:
+                    if os.path.exists(face_path):
+                        os.remove(face_path)
+                    if backup_path is not None:
+                        os.replace(backup_path, face_path)
+                except Exception as restore_error:
+                    print(f"Error restoring {face_path}: {str(restore_error)}", file=sys.stderr)
+            self.load_known_faces()
+            for item in registered:
+                item["result"].pop("face_path", None)
+                item["result"]["message"] = f"Lỗi cập nhật dữ liệu: {str(e)}"
+            for result, _, _, _ in batch_same_photos:
+                result["message"] = f"Lỗi cập nhật dữ liệu: {str(e)}"
+            return {"success": False, "message": f"Lỗi cập nhật dữ liệu: {str(e)}", "results": results}
+        finally:
+            for item in staged_items:
+                if os.path.exists(item["staged"]):
+                    os.remove(item["staged"])
+            if committed:
+                for _, backup_path in replaced:
+                    if backup_path is not None and os.path.exists(backup_path):
+                        os.remove(backup_path)
+        
+        for item in registered:
+            item["result"].update({"success": True, "message": "Đăng ký khuôn mặt thành công"})
+        for result, employee_id, face_filename, quality in batch_same_photos:
+            result.update(self.same_photo_result(employee_id, face_filename, quality))
+        
+        return {
+            "success": True,
+            "total": len(results),
+            "registered": len(registered),
+            "skipped": sum(1 for result in results if result.get("skipped")),
+            "failed": sum(1 for result in results if not result["success"]),
+            "results": results
+        }
+
+    def prepare_frame(self, frame, frame_scale):
+        """Resize frame BGR để xử lý nhanh hơn (performance.frame_scale)"""
+        if frame_scale != 1:
+            return cv2.resize(frame, (0, 0), fx=frame_scale, fy=frame_scale)
+        return frame
+
+    def locate_faces(self, frame, frame_scale):
+        """Resize + phát hiện khuôn mặt trên một frame BGR (chạy trên worker thread)"""
+        small_frame = self.prepare_frame(frame, frame_scale)
+        rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+        gray_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY)
+        with self.metrics.span("detection"):
+            face_locations = face_recognition.face_locations(
+                rgb_small_frame, number_of_times_to_upsample=self.upsample_times, model=self.detection_model
+            )
+        return rgb_small_frame, gray_small_frame, face_locations
+
+    def encode_faces(self, rgb_image, face_locations):
+        """Tính encoding cho các vị trí khuôn mặt đã biết (chạy trên worker thread)"""
+        with self.metrics.span("encoding"):
+            return face_recognition.face_encodings(rgb_image, face_locations, num_jitters=self.recognition_num_jitters)
+
+    def save_attendance_image(self, employee_id, frame, face_box=None, camera_id=None):
+        """Xếp ảnh chấm công vào hàng đợi ghi nền nếu được cấu hình, trả về đường dẫn hoặc None"""
+        if not self.config.get("save_attendance_images", True):
+            return None
+        
+        if self.attendance_writer is None:
+            self.attendance_writer = AttendanceImageWriter(
+                self.config.get("attendance_images_folder", "attendance_images"),
+                jpeg_quality=self.config.get("attendance_image_quality", 90),
+                crop_face=self.config.get("attendance_image_crop_face", False),
+                shard_by_date=self.config.get("attendance_image_date_folders", True),
+                queue_size=self.config.get("attendance_image_queue_size", 16),
+                metrics=self.metrics
+            )
+        return self.attendance_writer.submit(employee_id, frame, face_box, camera_id)
+
+    def close(self):
+        """Giải phóng tài nguyên nền (ghi nốt ảnh chấm công đang chờ, lưu metrics)"""
+        if self.attendance_writer is not None:
+            self.attendance_writer.close()
+            self.attendance_writer = None
+        try:
+            self.metrics.flush()
+        except Exception as e:
+            print(f"Error saving metrics: {str(e)}", file=sys.stderr)
+
+    def get_stats(self):
+        """Thống kê độ trễ p50/p95/p99 theo giai đoạn và các bộ đếm frame"""
+        try:
+            return dict({"success": True}, **self.metrics.snapshot())
+        except Exception as e:
+            return {"success": False, "message": f"Lỗi hệ thống: {str(e)}"}
+
+    def create_tracker(self):
+        """Tạo FaceTracker theo mục "tracking" trong config.json"""
+        tracking = self.config.get("tracking", {})
+        return FaceTracker(
+            detection_interval=tracking.get("detection_interval", 5),
+            iou_threshold=tracking.get("iou_threshold", 0.3),
+            template_threshold=tracking.get("template_threshold", 0.6),
+            max_missed_detections=tracking.get("max_missed_detections", 1),
+            max_track_encodings=tracking.get("max_track_encodings", 5)
+        )
+
+    def create_decision(self):
+        """Tạo IdentityDecision theo mục "decision" trong config.json"""
+        decision = self.config.get("decision", {})
+        return IdentityDecision(
+            window_seconds=decision.get("window_seconds", 2.0),
+            min_observations=decision.get("min_observations", 2),
+            min_margin=decision.get("min_margin", 0.05),
+            instant_accept_margin=decision.get("instant_accept_margin", 0.2)
+        )
+
+    def open_frame_source(self, source=None):
+        """Tạo nguồn frame: source (chuỗi --source hoặc dict) nếu có, không thì
+        mục "frame_source" trong config.json, mặc định là camera_index"""
+        if source is not None:
+            source_config = parse_frame_source_spec(source)
+        else:
+            source_config = dict(self.config.get("frame_source") or {"type": "camera"})
+        if source_config.get("type", "camera") == "camera":
+            source_config.setdefault("index", self.config.get("camera_index", 0))
+            source_config.setdefault("width", self.config.get("frame_width", 640))
+            source_config.setdefault("height", self.config.get("frame_height", 480))
+            source_config.setdefault("fps", 30)
+        return create_frame_source(source_config)
+
+    def publish_frames(self, source=None, name=None, timeout=None):
+        """Đọc nguồn frame và đẩy vào shared memory cho các recognizer khác dùng chung.
+
+        Chạy đến khi nguồn hết frame, hết timeout (nếu có) hoặc bị Ctrl+C.
+        """
+        publisher_config = self.config.get("frame_publisher", {})
+        publisher = SharedMemoryFramePublisher(name or publisher_config.get("name", "face_frames"),
+                                               publisher_config.get("buffer_size", 4))
+        frame_source = None
+        start_time = time.time()
+        try:
+            frame_source = self.open_frame_source(source)
+            if not frame_source.isOpened():
                 return {"success": False, "message": "Không thể mở camera"}
             
-            # Cài đặt độ phân giải camera
-            cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.config.get("frame_width", 640))
-            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.config.get("frame_height", 480))
-            cap.set(cv2.CAP_PROP_FPS, 30)
-            
-            start_time = time.time()
-            process_this_frame = True
-            frame_count = 0
-            
-            while True:
-                ret, frame = cap.read()
+            print(f"Publishing frames to shared memory '{publisher.name}'", file=sys.stderr)
+            failures = 0
+            while not timeout or time.time() - start_time < timeout:
+                ret, frame = frame_source.read()
                 if not ret:
-                    time.sleep(0.1)
+                    if frame_source.finite:
+                        break
+                    failures += 1
+                    time.sleep(0.1 if failures > 1 else 0)
                     continue
-                
-                frame_count += 1
-                
+                failures = 0
+                publisher.publish(frame)
+            return {"success": True, "frames_published": publisher.frames_published}
+        except KeyboardInterrupt:
+            return {"success": True, "frames_published": publisher.frames_published}
+        except Exception as e:
+            return {"success": False, "message": f"Lỗi hệ thống: {str(e)}"}
+        finally:
+            if frame_source is not None:
+                frame_source.release()
+            publisher.close()
+
+    def run_camera_pipelines(self, pipelines, timeout, on_recognition, idle_timeout=None):
+        """Vòng lặp điều phối chung cho một hoặc nhiều camera, trả về lý do dừng.
+
+        Detect/encode chạy trên một ThreadPoolExecutor dùng chung (dlib nhả GIL).
+        Mỗi vòng duyệt camera theo round-robin với điểm bắt đầu xoay vòng, mỗi
+        camera giữ tối đa max_pending/N job để camera bận không chiếm hết worker.
+        Tracking, so khớp gallery và on_recognition(pipeline, recognition) chạy trên
+        thread gọi; on_recognition trả về True để dừng ("recognized"). Các lý do khác:
+        "timeout", "idle" (mọi camera không thấy khuôn mặt quá idle_timeout giây),
+        "exhausted" (nguồn phát lại hết frame), "cancelled" (phím ESC).
+        """
+        # 0/không cấu hình = tự chọn theo số CPU
+        worker_count = max(1, int(self.performance.get("pipeline_workers") or min(4, os.cpu_count() or 1)))
+        max_pending = max(1, int(self.performance.get("max_pending_frames") or worker_count))
+        per_camera_pending = max(1, max_pending // len(pipelines))
+        
+        wake = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="face-detect")
+        pending = {}
+        for pipeline in pipelines:
+            pipeline.start(wake)
+        
+        def submit(pipeline, job, fn, *args):
+            future = executor.submit(fn, *args)
+            future.add_done_callback(lambda _: wake.set())
+            pending[future] = (pipeline, job)
+            pipeline.in_flight += 1
+        
+        start_time = time.time()
+        offset = 0
+        try:
+            while True:
                 # Kiểm tra timeout
-                elapsed_time = time.time() - start_time
-                if elapsed_time > timeout:
-                    break
+                if timeout and time.time() - start_time > timeout:
+                    return "timeout"
+                if idle_timeout and all(pipeline.idle_seconds > idle_timeout for pipeline in pipelines):
+                    return "idle"
+                if all(pipeline.finished for pipeline in pipelines):
+                    return "exhausted"  # Mọi nguồn phát lại đã hết frame
+                wake.clear()
                 
-                # Xử lý mỗi frame thứ 3 để tăng tốc độ
-                if frame_count % 3 != 0:
-                    continue
+                for i in range(len(pipelines)):
+                    pipeline = pipelines[(offset + i) % len(pipelines)]
+                    can_submit = len(pending) < max_pending and pipeline.in_flight < per_camera_pending
+                    next_frame = pipeline.next_frame(can_submit)
+                    if next_frame is not None:
+                        sequence, frame = next_frame
+                        submit(pipeline, {"kind": "detect", "sequence": sequence, "frame": frame},
+                               self.locate_faces, frame, pipeline.frame_scale)
+                offset = (offset + 1) % len(pipelines)
                 
-                if process_this_frame:
-                    # Resize frame để xử lý nhanh hơn
-                    small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-                    rgb_small_frame = small_frame[:, :, ::-1]
-                    
+                for future in [f for f in pending if f.done()]:
+                    pipeline, job = pending.pop(future)
+                    pipeline.in_flight -= 1
                     try:
-                        # Tìm khuôn mặt trong frame
-                        face_locations = face_recognition.face_locations(rgb_small_frame, model="hog")
-                        if len(face_locations) == 0:
-                            process_this_frame = not process_this_frame
+                        if job["kind"] == "detect":
+                            rgb_small_frame, gray_small_frame, face_locations = future.result()
+                            tracks = pipeline.handle_detection(job["sequence"], gray_small_frame, face_locations)
+                            if tracks:
+                                submit(pipeline, dict(job, kind="encode", tracks=tracks),
+                                       self.encode_faces, rgb_small_frame, [track.box for track in tracks])
                             continue
-                            
-                        face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
                         
-                        for face_encoding in face_encodings:
-                            if len(self.known_face_encodings) == 0:
-                                continue
-                                
-                            # So sánh với khuôn mặt đã biết
-                            face_distances = face_recognition.face_distance(self.known_face_encodings, face_encoding)
-                            
-                            if len(face_distances) > 0:
-                                best_match_index = np.argmin(face_distances)
-                                confidence = 1 - face_distances[best_match_index]
-                                
-                                if face_distances[best_match_index] < self.tolerance and confidence > self.confidence_threshold:
-                                    employee_id = self.known_employee_ids[best_match_index]
-                                    employee_name = self.known_face_names[best_match_index]
-                                    
-                                    # Lưu ảnh chấm công nếu được cấu hình
-                                    attendance_image_path = None
-                                    if self.config.get("save_attendance_images", True):
-                                        attendance_folder = self.config.get("attendance_images_folder", "attendance_images")
-                                        os.makedirs(attendance_folder, exist_ok=True)
-                                        
-                                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                                        attendance_image_path = os.path.join(
-                                            attendance_folder, 
-                                            f"{employee_id}_{timestamp}.jpg"
-                                        )
-                                        try:
-                                            cv2.imwrite(attendance_image_path, frame)
-                                        except:
-                                            attendance_image_path = None
-                                    
-                                    return {
-                                        "success": True,
-                                        "employee_id": employee_id,
-                                        "employee_name": employee_name,
-                                        "confidence": round(confidence * 100, 2),
-                                        "timestamp": datetime.now().isoformat(),
-                                        "attendance_image": attendance_image_path
-                                    }
+                        for recognition in pipeline.handle_encodings(job, future.result()):
+                            if on_recognition(pipeline, recognition):
+                                return "recognized"
                     except Exception as e:
                         print(f"Face recognition error: {str(e)}", file=sys.stderr)
                         continue
                 
-                process_this_frame = not process_this_frame
-                
                 # Kiểm tra key press để thoát sớm (optional)
                 if cv2.waitKey(1) & 0xFF == 27:  # ESC key
-                    break
+                    return "cancelled"
+                
+                # Chờ frame mới hoặc job xong
+                wake.wait(0.05)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def record_pipeline_stats(self, pipeline):
+        """In và cộng dồn bộ đếm frame của một camera vào metrics"""
+        label = "Camera pipeline stats" if pipeline.camera_id is None else f"Camera {pipeline.camera_id} pipeline stats"
+        print(f"{label}: {json.dumps(pipeline.stats)}", file=sys.stderr)
+        for name, count in pipeline.stats.items():
+            self.metrics.increment(name, count)
+
+    def recognize_face_from_camera(self, timeout=30, continuous=False, frame_source=None):
+        """Nhận diện khuôn mặt từ camera với timeout cải tiến.
+
+        Pipeline nhiều luồng: một thread đọc camera và chỉ giữ frame mới nhất,
+        detect/encode chạy song song trên ThreadPoolExecutor (dlib nhả GIL),
+        theo dõi khuôn mặt và so khớp gallery chạy trên thread gọi.
+        Với continuous=True, không dừng ở người đầu tiên mà ghi nhận mọi nhân
+        viên xuất hiện cho đến hết timeout.
+        frame_source: FrameSource hoặc chuỗi/dict cấu hình nguồn (xem open_frame_source);
+        với nguồn hữu hạn (video, thư mục ảnh) vòng lặp kết thúc khi hết frame.
+        Kết quả được xác nhận qua IdentityDecision (config.json "decision"). Khi không
+        continuous, phiên dừng sớm nếu không thấy khuôn mặt nào trong
+        decision.idle_timeout giây (0 để tắt).
+        """
+        source = None
+        pipeline = None
+        stop_reason = None
+        recognitions = []
+        session_start = time.perf_counter()
+        try:
+            with self.metrics.span("camera_open"):
+                source = frame_source if isinstance(frame_source, FrameSource) else self.open_frame_source(frame_source)
+                if not source.isOpened():
+                    return {"success": False, "message": "Không thể mở camera"}
+            
+            pipeline = CameraPipeline(self, None, source, self.performance.get("frame_scale", 0.25))
             
+            def on_recognition(_, recognition):
+                recognitions.append(recognition)
+                return not continuous
+            
+            # continuous chạy đến hết timeout dù có lúc không ai trước camera
+            idle_timeout = None if continuous else self.config.get("decision", {}).get("idle_timeout", 5.0)
+            stop_reason = self.run_camera_pipelines([pipeline], timeout, on_recognition, idle_timeout)
+            
+            if recognitions and not continuous:
+                return recognitions[0]
+            if continuous and recognitions:
+                return {"success": True, "recognitions": recognitions}
+            if stop_reason == "idle":
+                return {"success": False, "message": f"Không phát hiện khuôn mặt trong {idle_timeout:g} giây, dừng nhận diện"}
             return {"success": False, "message": "Không nhận diện được khuôn mặt trong thời gian cho phép"}
             
         except Exception as e:
             return {"success": False, "message": f"Lỗi hệ thống: {str(e)}"}
         finally:
-            if cap is not None:
-                cap.release()
+            if pipeline is not None:
+                pipeline.stop()
+                self.record_pipeline_stats(pipeline)
+            elif source is not None:
+                source.release()
             cv2.destroyAllWindows()
-    
+            
+            duration_ms = (time.perf_counter() - session_start) * 1000.0
+            self.metrics.record("recognize_camera", duration_ms)
+            if stop_reason is not None:
+                self.metrics.increment(f"camera_stop.{stop_reason}")
+            logger.info("camera_session", extra={"fields": dict(pipeline.stats if pipeline else {}, recognized=len(recognitions),
+                                                                  stop_reason=stop_reason, duration_ms=round(duration_ms, 1))})
+
+    def recognize_multiple_cameras(self, timeout=None, emit=None):
+        """Nhận diện liên tục trên mọi camera trong mục "cameras" của config.json.
+
+        Gallery và model chỉ nạp một lần cho tất cả camera; các camera dùng chung
+        worker pool (xem run_camera_pipelines). Kết quả được phát dưới dạng sự kiện
+        JSON qua emit(event): camera_started, camera_error, recognition,
+        camera_stopped. Không có emit thì sự kiện được gom vào "events" của kết quả.
+        timeout None/0 = chạy đến khi mọi nguồn hết frame hoặc bị Ctrl+C.
+        """
+        cameras = self.config.get("cameras") or []
+        if not cameras:
+            return {"success": False, "message": "Chưa cấu hình danh sách cameras trong config.json"}
+        
+        defaults = self.config.get("multi_camera", {})
+        events = []
+        emit = emit or events.append
+        pipelines = []
+        recognition_count = 0
+        session_start = time.perf_counter()
+        try:
+            for index, camera in enumerate(cameras):
+                camera_id = str(camera.get("id", index))
+                try:
+                    source = self.open_frame_source(camera.get("source", index))
+                    opened = source.isOpened()
+                except Exception as e:
+                    source, opened = None, False
+                    print(f"Error opening camera {camera_id}: {str(e)}", file=sys.stderr)
+                if not opened:
+                    if source is not None:
+                        source.release()
+                    emit({"event": "camera_error", "camera_id": camera_id, "message": "Không thể mở camera"})
+                    continue
+                
+                pipelines.append(CameraPipeline(
+                    self, camera_id, source,
+                    camera.get("frame_scale", self.performance.get("frame_scale", 0.25)),
+                    fps_budget=camera.get("fps_budget", defaults.get("fps_budget", 5)),
+                    recognition_cooldown=camera.get("recognition_cooldown", defaults.get("recognition_cooldown", 60))
+                ))
+                emit({"event": "camera_started", "camera_id": camera_id, "timestamp": datetime.now().isoformat()})
+            
+            if not pipelines:
+                return {"success": False, "message": "Không thể mở camera"}
+            
+            def on_recognition(pipeline, recognition):
+                nonlocal recognition_count
+                recognition_count += 1
+                event = {"event": "recognition", "camera_id": pipeline.camera_id}
+                event.update((k, v) for k, v in recognition.items() if k != "success")
+                emit(event)
+                return False
+            
+            try:
+                self.run_camera_pipelines(pipelines, timeout, on_recognition)
+            except KeyboardInterrupt:
+                pass
+            
+            result = {"success": True, "cameras": len(pipelines), "recognitions": recognition_count}
+            if events:
+                result["events"] = events
+            return result
+            
+        except Exception as e:
+            return {"success": False, "message": f"Lỗi hệ thống: {str(e)}"}
+        finally:
+            for pipeline in pipelines:
+                pipeline.stop()
+                self.record_pipeline_stats(pipeline)
+                emit({"event": "camera_stopped", "camera_id": pipeline.camera_id, "stats": pipeline.stats})
+            cv2.destroyAllWindows()
+            self.metrics.record("recognize_cameras", (time.perf_counter() - session_start) * 1000.0)
+
     def delete_registered_face(self, employee_id):
         """Xóa khuôn mặt đã đăng ký"""
         try:
-            deleted = False
+            deleted_files = []
             files_to_delete = []
             
             if not os.path.exists(self.faces_folder):
@@ -392,12 +2739,16 @@ class FaceRecognitionService:
                 try:
                     file_path = os.path.join(self.faces_folder, filename)
                     os.remove(file_path)
-                    deleted = True
+                    deleted_files.append(filename)
                 except Exception as e:
                     print(f"Error deleting {filename}: {str(e)}", file=sys.stderr)
             
-            if deleted:
-                self.load_known_faces()
+            if deleted_files:
+                # Chỉ bỏ các dòng của nhân viên này khỏi gallery
+                for filename in deleted_files:
+                    self.cache_entries.pop(filename, None)
+                    self.gallery.remove(filename)
+                self.journal_gallery_change({"op": "remove", "files": deleted_files})
                 return {"success": True, "message": "Xóa khuôn mặt thành công"}
             else:
                 return {"success": False, "message": "Không tìm thấy khuôn mặt để xóa"}
@@ -406,54 +2757,253 @@ class FaceRecognitionService:
             return {"success": False, "message": f"Lỗi hệ thống: {str(e)}"}
     
     def get_registered_faces(self):
-        """Lấy danh sách khuôn mặt đã đăng ký"""
+        """Lấy danh sách nhân viên đã đăng ký, kèm số ảnh và chất lượng ảnh tốt nhất"""
         try:
             faces = []
-            for i in range(len(self.known_employee_ids)):
+            for employee_id, rows in self.gallery.employee_rows.items():
+                rows = sorted(rows)
                 faces.append({
-                    "employee_id": self.known_employee_ids[i],
-                    "employee_name": self.known_face_names[i]
+                    "employee_id": employee_id,
+                    "employee_name": self.gallery.employee_names[rows[0]],
+                    "photo_count": len(rows),
+                    "quality": round(max(self.gallery.qualities[row] for row in rows), 4)
                 })
+            faces.sort(key=lambda face: face["employee_id"])
             return {"success": True, "faces": faces}
         except Exception as e:
             return {"success": False, "message": f"Lỗi hệ thống: {str(e)}", "faces": []}
 
+def execute_action(service, action, params, use_alarm_timeout=True):
+    """Thực thi một action và trả về dict kết quả (dùng chung cho CLI và chế độ serve)"""
+    return run_timed_action(service, action, lambda: dispatch_action(service, action, params, use_alarm_timeout))
+
+def run_timed_action(service, action, run):
+    """Chạy run() (trả về dict kết quả), ghi metric action.* và dòng log "action" cho kết quả"""
+    start = time.perf_counter()
+    result = run()
+    duration_ms = (time.perf_counter() - start) * 1000.0
+    if action != 'stats':
+        service.metrics.record(f"action.{action}", duration_ms)
+        service.metrics.increment(f"action.{action}.{'success' if result.get('success') else 'failed'}")
+    logger.info("action", extra={"fields": {
+        "action": action, "success": result.get("success"),
+        "message": result.get("message"), "duration_ms": round(duration_ms, 1)
+    }})
+    return result
+
+def dispatch_action(service, action, params, use_alarm_timeout=True):
+    if action == 'register':
+        employee_id = params.get('employee_id')
+        employee_name = params.get('employee_name')
+        image_path = params.get('image_path')
+        if not employee_id or not employee_name or not image_path:
+            return {"success": False, "message": "Thiếu tham số bắt buộc: employee_id, employee_name, image_path"}
+        if use_alarm_timeout:
+            # Use timeout wrapper for registration
+            return service.register_face_with_timeout(employee_id, employee_name, image_path, 60,
+                                                      bool(params.get('additional')))
+        return service.register_face(employee_id, employee_name, image_path, bool(params.get('additional')))
+        
+    elif action == 'recognize_camera':
+        return service.recognize_face_from_camera(params.get('timeout') or 30, bool(params.get('continuous')),
+                                                  params.get('source'))
+    
+    elif action == 'recognize_cameras':
+        return service.recognize_multiple_cameras(params.get('timeout') or 30)
+    
+    elif action == 'recognize_image':
+        image_path = params.get('image_path')
+        if params.get('image_list') or (isinstance(image_path, str) and os.path.isdir(image_path)):
+            image_paths = collect_image_paths(image_path, params.get('image_list'))
+            return {"success": True, "results": list(service.recognize_images(image_paths))}
+        if not image_path:
+            return {"success": False, "message": "Thiếu tham số image_path"}
+        return service.recognize_image(image_path)
+        
+    elif action == 'register_bulk':
+        if not params.get('manifest'):
+            return {"success": False, "message": "Thiếu tham số manifest"}
+        return service.register_faces_bulk(params.get('manifest'))
+        
+    elif action == 'delete':
+        if not params.get('employee_id'):
+            return {"success": False, "message": "Thiếu tham số employee_id"}
+        return service.delete_registered_face(params.get('employee_id'))
+        
+    elif action == 'list':
+        return service.get_registered_faces()
+    
+    elif action == 'stats':
+        return service.get_stats()
+    
+    elif action == 'ping':
+        return {"success": True, "message": "pong", "known_faces": len(service.gallery)}
+        
+    return {"success": False, "message": f"Hành động không được hỗ trợ: {action}"}
+
+class RecognitionServer:
+    """Giữ FaceRecognitionService thường trú và nhận request JSON theo từng dòng.
+
+    Mỗi request là một object JSON trên một dòng, ví dụ
+    {"id": 1, "action": "recognize_camera", "timeout": 10}; response là dict kết
+    quả giống hệt output của CLI, kèm lại "id" nếu request có gửi.
+    """
+    def __init__(self, service):
+        self.service = service
+        self.lock = threading.Lock()
+        self.shutdown_event = threading.Event()
+
+    def handle_line(self, line):
+        """Xử lý một dòng request (bytes UTF-8 hoặc str), trả về dòng response (không kèm newline)
+
+        Dòng không decode được UTF-8 chỉ nhận response lỗi, không làm dừng vòng đọc.
+        """
+        request_id = None
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8-sig')
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request phải là một JSON object")
+            request_id = request.get('id')
+            action = request.get('action')
+            
+            if action == 'shutdown':
+                self.shutdown_event.set()
+                result = {"success": True, "message": "Đang dừng dịch vụ"}
+            else:
+                # Service không thread-safe (gallery, camera) nên xử lý tuần tự
+                with self.lock:
+                    result = execute_action(self.service, action, request,
+                                            use_alarm_timeout=threading.current_thread() is threading.main_thread())
+        except ValueError as e:
+            result = {"success": False, "message": f"Request không hợp lệ: {str(e)}"}
+        except Exception as e:
+            result = {"success": False, "message": f"Lỗi hệ thống: {str(e)}"}
+        
+        if request_id is not None:
+            result = dict(result, id=request_id)
+        return json.dumps(result, ensure_ascii=False, separators=(',', ':'))
+
+    def serve_stdio(self):
+        """Đọc request từ stdin, ghi response ra stdout
+
+        Đọc bytes và để handle_line decode UTF-8 như kênh socket: sys.stdin dạng text
+        trên Windows dùng code page ANSI và làm hỏng tên tiếng Việt.
+        """
+        for raw_line in sys.stdin.buffer:
+            line = raw_line.strip()
+            if not line:
+                continue
+            sys.stdout.write(self.handle_line(line) + "\n")
+            sys.stdout.flush()
+            if self.shutdown_event.is_set():
+                break
+
+    def serve_socket(self, host=None, port=None, socket_path=None):
+        """Lắng nghe trên TCP (localhost) hoặc Unix socket"""
+        server = self
+
+        class LineHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for raw_line in self.rfile:
+                    line = raw_line.strip()
+                    if not line:
+                        continue
+                    self.wfile.write((server.handle_line(line) + "\n").encode('utf-8'))
+                    self.wfile.flush()
+                    if server.shutdown_event.is_set():
+                        break
+
+        if socket_path:
+            if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+                raise RuntimeError("Unix socket không được hỗ trợ trên hệ điều hành này")
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            listener = socketserver.ThreadingUnixStreamServer(socket_path, LineHandler)
+            address = socket_path
+        else:
+            listener = socketserver.ThreadingTCPServer((host or '127.0.0.1', port), LineHandler)
+            address = "%s:%d" % listener.server_address[:2]
+        listener.daemon_threads = True
+
+        def stop_when_requested():
+            self.shutdown_event.wait()
+            listener.shutdown()
+        threading.Thread(target=stop_when_requested, daemon=True).start()
+
+        print(f"Face recognition service listening on {address}", file=sys.stderr)
+        try:
+            listener.serve_forever()
+        finally:
+            listener.server_close()
+            if socket_path and os.path.exists(socket_path):
+                os.remove(socket_path)
+
 def main():
     """Main function để gọi từ command line"""
+    service = None
     try:
         parser = argparse.ArgumentParser(description='Face Recognition Service')
-        parser.add_argument('action', choices=['register', 'recognize_camera', 'recognize_image', 'delete', 'list'])
+        parser.add_argument('action', choices=['register', 'register_bulk', 'recognize_camera', 'recognize_cameras', 'recognize_image', 'delete', 'list', 'stats', 'publish_frames', 'serve'])
         parser.add_argument('--employee_id', help='Employee ID')
         parser.add_argument('--employee_name', help='Employee Name')
-        parser.add_argument('--image_path', help='Path to image file')
-        parser.add_argument('--timeout', type=int, default=30, help='Recognition timeout in seconds')
+        parser.add_argument('--image_path', help='Path to image file (file, thư mục, data:image base64 hoặc "-" để đọc bytes ảnh từ stdin)')
+        parser.add_argument('--additional', action='store_true', help='register: thêm ảnh cho nhân viên đã có thay vì thay ảnh chính')
+        parser.add_argument('--image_list', help='recognize_image: file chứa danh sách đường dẫn ảnh, mỗi dòng một ảnh')
+        parser.add_argument('--manifest', help='register_bulk: file CSV/JSONL gồm employee_id, employee_name, image_path')
+        parser.add_argument('--timeout', type=int, help='Recognition timeout in seconds (mặc định 30; publish_frames: chạy đến khi dừng)')
+        parser.add_argument('--continuous', action='store_true', help='recognize_camera: nhận diện nhiều người đến hết timeout')
+        parser.add_argument('--source', help='recognize_camera/publish_frames: số camera, file video, thư mục ảnh, URL hoặc shm:<tên>')
+        parser.add_argument('--shm_name', help='publish_frames: tên vùng shared memory (mặc định frame_publisher.name)')
+        parser.add_argument('--host', default='127.0.0.1', help='serve: TCP host')
+        parser.add_argument('--port', type=int, help='serve: TCP port (mặc định dùng stdin/stdout)')
+        parser.add_argument('--socket', help='serve: Unix socket path')
         
         args = parser.parse_args()
         
+        if args.image_path == '-' and args.action in ('register', 'recognize_image'):
+            # Bytes JPEG/PNG thô từ stdin, tránh 33% dung lượng tăng thêm của base64
+            args.image_path = sys.stdin.buffer.read()
+        
         service = FaceRecognitionService()
-        result = None
         
-        if args.action == 'register':
-            if not args.employee_id or not args.employee_name or not args.image_path:
-                result = {"success": False, "message": "Thiếu tham số bắt buộc: employee_id, employee_name, image_path"}
-            else:
-                # Use timeout wrapper for registration
-                result = service.register_face_with_timeout(args.employee_id, args.employee_name, args.image_path, 60)
-                
-        elif args.action == 'recognize_camera':
-            result = service.recognize_face_from_camera(args.timeout)
-            
-        elif args.action == 'delete':
-            if not args.employee_id:
-                result = {"success": False, "message": "Thiếu tham số employee_id"}
+        if args.action == 'serve':
+            server = RecognitionServer(service)
+            if args.port or args.socket:
+                server.serve_socket(args.host, args.port, args.socket)
             else:
-                result = service.delete_registered_face(args.employee_id)
-                
-        elif args.action == 'list':
-            result = service.get_registered_faces()
-            
-        else:
-            result = {"success": False, "message": f"Hành động không được hỗ trợ: {args.action}"}
+                server.serve_stdio()
+            return
+        
+        # Các action in kết quả dạng luồng vẫn đi qua run_timed_action để có metric/log như các action khác
+        if args.action == 'recognize_cameras':
+            # Dòng sự kiện JSON, mỗi sự kiện một dòng ngay khi có
+            result = run_timed_action(service, args.action, lambda: service.recognize_multiple_cameras(
+                args.timeout, emit=lambda event: print(json.dumps(event, ensure_ascii=False, separators=(',', ':')), flush=True)
+            ))
+            print(json.dumps(result, ensure_ascii=False, separators=(',', ':')))
+            return
+        
+        if args.action == 'publish_frames':
+            result = run_timed_action(service, args.action,
+                                      lambda: service.publish_frames(args.source, args.shm_name, args.timeout))
+            print(json.dumps(result, ensure_ascii=False, separators=(',', ':')))
+            return
+        
+        if args.action == 'recognize_image' and (args.image_list or (isinstance(args.image_path, str) and os.path.isdir(args.image_path))):
+            # Chế độ batch: in mỗi kết quả trên một dòng ngay khi có
+            def recognize_batch():
+                total = failed = 0
+                for image_result in service.recognize_images(collect_image_paths(args.image_path, args.image_list)):
+                    print(json.dumps(image_result, ensure_ascii=False, separators=(',', ':')), flush=True)
+                    total += 1
+                    failed += 0 if image_result.get("success") else 1
+                return {"success": True, "message": f"{total} ảnh, {failed} lỗi", "total": total, "failed": failed}
+            run_timed_action(service, args.action, recognize_batch)
+            return
+        
+        result = execute_action(service, args.action, vars(args))
         
         # Output với encoding an toàn
         if result:
@@ -470,6 +3020,9 @@ def main():
             "message": f"Lỗi hệ thống: {str(e)}"
         }
         print(json.dumps(error_result, ensure_ascii=False))
+    finally:
+        if service is not None:
+            service.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
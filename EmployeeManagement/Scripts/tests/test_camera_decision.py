@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Kiểm tra bộ quyết định IdentityDecision và FaceTracker (ghép IoU, mất dấu).
+
+Chạy được khi chưa cài dlib:
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import types
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import face_recognition  # noqa: F401
+except ImportError:
+    # Module service import face_recognition ở đầu file; các lớp được kiểm tra không gọi tới
+    sys.modules["face_recognition"] = types.ModuleType("face_recognition")
+
+from face_recognition_service import FaceTrack, FaceTracker, IdentityDecision, box_iou
+
+
+def face(employee_id, margin, matched=True):
+    """Kết quả identify_faces rút gọn cho một khuôn mặt"""
+    return {"employee_id": employee_id if matched else None, "matched": matched, "margin": margin}
+
+
+def textured_image(seed, size=200):
+    return np.random.default_rng(seed).integers(0, 256, (size, size), dtype=np.uint8)
+
+
+class IdentityDecisionTest(unittest.TestCase):
+    def setUp(self):
+        self.decision = IdentityDecision(window_seconds=2.0, min_observations=2, min_margin=0.05,
+                                         instant_accept_margin=0.2)
+        self.track = FaceTrack(1, (0, 10, 10, 0), None)
+
+    def test_large_margin_is_accepted_instantly(self):
+        self.assertTrue(self.decision.observe(self.track, face("E1", 0.25), now=0.0))
+
+    def test_without_runner_up_is_accepted_instantly(self):
+        # Gallery chỉ có một nhân viên: không có margin
+        self.assertTrue(self.decision.observe(self.track, face("E1", None), now=0.0))
+
+    def test_unmatched_face_is_never_accepted(self):
+        for now in (0.0, 0.1, 0.2):
+            self.assertFalse(self.decision.observe(self.track, face(None, None, matched=False), now=now))
+        self.assertEqual([employee_id for _, employee_id in self.track.evidence], [None, None, None])
+
+    def test_margin_below_minimum_does_not_count(self):
+        for now in (0.0, 0.1, 0.2):
+            self.assertFalse(self.decision.observe(self.track, face("E1", 0.01), now=now))
+
+    def test_needs_min_observations(self):
+        self.assertFalse(self.decision.observe(self.track, face("E1", 0.1), now=0.0))
+        self.assertTrue(self.decision.observe(self.track, face("E1", 0.1), now=0.5))
+
+    def test_leader_must_beat_runner_up(self):
+        self.assertFalse(self.decision.observe(self.track, face("E1", 0.1), now=0.0))
+        self.assertTrue(self.decision.observe(self.track, face("E1", 0.1), now=0.1))
+        self.assertFalse(self.decision.observe(self.track, face("E2", 0.1), now=0.2))
+        # E2 đủ min_observations nhưng hòa phiếu với E1
+        self.assertFalse(self.decision.observe(self.track, face("E2", 0.1), now=0.3))
+        self.assertTrue(self.decision.observe(self.track, face("E2", 0.1), now=0.4))
+
+    def test_unsupported_observations_do_not_vote(self):
+        self.assertFalse(self.decision.observe(self.track, face("E1", 0.1), now=0.0))
+        self.assertFalse(self.decision.observe(self.track, face("E1", 0.01), now=0.1))
+        self.assertFalse(self.decision.observe(self.track, face(None, None, matched=False), now=0.2))
+        self.assertTrue(self.decision.observe(self.track, face("E1", 0.1), now=0.3))
+
+    def test_old_observations_expire(self):
+        self.assertFalse(self.decision.observe(self.track, face("E1", 0.1), now=0.0))
+        self.assertFalse(self.decision.observe(self.track, face("E1", 0.1), now=3.0))
+        self.assertEqual(len(self.track.evidence), 1)
+        self.assertTrue(self.decision.observe(self.track, face("E1", 0.1), now=3.5))
+
+
+class FaceTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = FaceTracker(detection_interval=3, iou_threshold=0.3, template_threshold=0.6,
+                                   max_missed_detections=1, max_track_encodings=3)
+        self.image = textured_image(0)
+
+    def test_new_detections_create_tracks_to_encode(self):
+        boxes = [(20, 80, 80, 20), (100, 180, 160, 120)]
+        to_encode = self.tracker.update_detections(boxes, self.image)
+        self.assertEqual([track.track_id for track in to_encode], [1, 2])
+        self.assertEqual([track.box for track in self.tracker.tracks], boxes)
+        self.assertFalse(self.tracker.needs_detection())
+
+    def test_detections_are_assigned_by_iou(self):
+        first, second = self.tracker.update_detections([(20, 80, 80, 20), (100, 180, 160, 120)], self.image)
+        first.identity = {"employee_id": "E1"}
+
+        # Cùng hai khuôn mặt, dịch nhẹ và trả về theo thứ tự ngược lại
+        to_encode = self.tracker.update_detections([(104, 184, 164, 124), (22, 82, 82, 22)], self.image)
+        self.assertEqual(first.box, (22, 82, 82, 22))
+        self.assertEqual(second.box, (104, 184, 164, 124))
+        self.assertEqual(len(self.tracker.tracks), 2)
+        # Track đã nhận diện giữ danh tính và không phải encode lại
+        self.assertEqual(first.identity, {"employee_id": "E1"})
+        self.assertEqual(to_encode, [second])
+
+    def test_low_iou_detection_starts_a_new_track(self):
+        (track,) = self.tracker.update_detections([(20, 80, 80, 20)], self.image)
+        track.identity = {"employee_id": "E1"}
+        self.assertLess(box_iou(track.box, (120, 180, 180, 120)), 0.3)
+
+        to_encode = self.tracker.update_detections([(120, 180, 180, 120)], self.image)
+        self.assertEqual([t.track_id for t in to_encode], [2])
+        self.assertIsNone(track.identity)
+        self.assertEqual(track.missed_detections, 1)
+
+    def test_missed_detection_resets_identity_then_drops_track(self):
+        (track,) = self.tracker.update_detections([(20, 80, 80, 20)], self.image)
+        track.identity = {"employee_id": "E1"}
+        track.encodings = [np.zeros(128, dtype=np.float32)]
+        track.evidence = [(0.0, "E1")]
+
+        self.assertEqual(self.tracker.update_detections([], self.image), [])
+        self.assertEqual(self.tracker.tracks, [track])
+        self.assertIsNone(track.identity)
+        self.assertEqual(track.encodings, [])
+        self.assertEqual(track.evidence, [])
+
+        self.tracker.update_detections([], self.image)
+        self.assertEqual(self.tracker.tracks, [])
+
+    def test_re_detected_track_is_encoded_again_after_a_miss(self):
+        (track,) = self.tracker.update_detections([(20, 80, 80, 20)], self.image)
+        track.identity = {"employee_id": "E1"}
+        self.tracker.update_detections([], self.image)
+        self.assertEqual(self.tracker.update_detections([(20, 80, 80, 20)], self.image), [track])
+
+    def test_follow_tracks_a_moving_face(self):
+        (track,) = self.tracker.update_detections([(60, 120, 120, 60)], self.image)
+        track.identity = {"employee_id": "E1"}
+        moved = np.roll(self.image, (4, -3), axis=(0, 1))
+
+        self.tracker.follow(moved)
+        self.assertEqual(track.box, (64, 117, 124, 57))
+        self.assertEqual(track.identity, {"employee_id": "E1"})
+        self.assertFalse(self.tracker.lost)
+
+    def test_follow_losing_the_template_resets_identity(self):
+        (track,) = self.tracker.update_detections([(60, 120, 120, 60)], self.image)
+        track.identity = {"employee_id": "E1"}
+        track.evidence = [(0.0, "E1")]
+
+        self.tracker.follow(textured_image(1))
+        self.assertTrue(self.tracker.lost)
+        self.assertTrue(self.tracker.needs_detection())
+        self.assertIsNone(track.identity)
+        self.assertEqual(track.evidence, [])
+
+    def test_detection_runs_every_interval(self):
+        self.tracker.update_detections([(60, 120, 120, 60)], self.image)
+        for _ in range(2):
+            self.tracker.follow(self.image)
+            self.assertFalse(self.tracker.needs_detection())
+        self.tracker.follow(self.image)
+        self.assertTrue(self.tracker.needs_detection())
+
+    def test_add_encoding_averages_recent_frames(self):
+        track = FaceTrack(1, (0, 10, 10, 0), None)
+        for value in (1.0, 2.0, 3.0, 4.0):
+            mean = self.tracker.add_encoding(track, np.full(128, value, dtype=np.float32))
+        self.assertEqual(len(track.encodings), 3)
+        np.testing.assert_allclose(mean, np.full(128, 3.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""Kiểm tra cache encoding (snapshot + journal), FaceGallery và IVFIndex.
+
+Các lớp này chỉ dùng NumPy nên chạy được khi chưa cài dlib:
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+import types
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import face_recognition  # noqa: F401
+except ImportError:
+    # Module service import face_recognition ở đầu file; các lớp được kiểm tra không gọi tới
+    sys.modules["face_recognition"] = types.ModuleType("face_recognition")
+
+from face_recognition_service import ENCODING_SIZE, FaceEncodingStore, FaceGallery, IVFIndex
+
+
+def make_encoding(rng):
+    return rng.normal(0.0, 0.1, ENCODING_SIZE).astype(np.float32)
+
+
+def make_entry(filename, row=None):
+    employee_id = filename.split("_")[0]
+    return {"file": filename, "mtime_ns": 1, "size": 1, "sha1": filename, "employee_id": employee_id,
+            "employee_name": "Test", "quality": 1.0, "row": row}
+
+
+def loaded_encodings(entries, matrix):
+    """{file: encoding hoặc None} từ kết quả FaceEncodingStore.load()"""
+    return {entry["file"]: None if entry["row"] is None else np.array(matrix[entry["row"]])
+            for entry in entries}
+
+
+class FaceEncodingStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = FaceEncodingStore(self.folder, {"model": "hog"})
+        self.rng = np.random.default_rng(0)
+        self.encodings = {name: make_encoding(self.rng) for name in ("A1_Test.jpg", "A2_Test.jpg", "A3_Test.jpg")}
+        entries = [make_entry(name, row) for row, name in enumerate(self.encodings)]
+        self.store.save(entries, np.stack(list(self.encodings.values())))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def reopen(self):
+        return FaceEncodingStore(self.folder, {"model": "hog"}).load()
+
+    def test_save_then_load_round_trips(self):
+        entries, matrix = self.reopen()
+        loaded = loaded_encodings(entries, matrix)
+        self.assertEqual(set(loaded), set(self.encodings))
+        for name, encoding in self.encodings.items():
+            np.testing.assert_array_equal(loaded[name], encoding)
+
+    def test_journal_replay_applies_add_and_remove(self):
+        added = make_encoding(self.rng)
+        self.store.append_journal({"op": "add", "entry": make_entry("B1_Test.jpg"), "encoding": added.tolist()})
+        self.store.append_journal({"op": "add", "entry": make_entry("B2_NoFace.jpg"), "encoding": None})
+        self.store.append_journal({"op": "remove", "files": ["A2_Test.jpg"]})
+
+        store = FaceEncodingStore(self.folder, {"model": "hog"})
+        entries, matrix = store.load()
+        loaded = loaded_encodings(entries, matrix)
+        self.assertEqual(store.journal_length, 3)
+        self.assertEqual(set(loaded), {"A1_Test.jpg", "A3_Test.jpg", "B1_Test.jpg", "B2_NoFace.jpg"})
+        np.testing.assert_allclose(loaded["B1_Test.jpg"], added)
+        self.assertIsNone(loaded["B2_NoFace.jpg"])
+        np.testing.assert_array_equal(loaded["A3_Test.jpg"], self.encodings["A3_Test.jpg"])
+
+    def test_journal_replay_is_idempotent(self):
+        replaced = make_encoding(self.rng)
+        record = {"op": "add", "entry": make_entry("A1_Test.jpg"), "encoding": replaced.tolist()}
+        self.store.append_journal(record)
+        first = loaded_encodings(*self.reopen())
+
+        # Ghi lại cùng bản ghi (crash trước khi compact rồi thao tác lại) và load nhiều lần
+        self.store.append_journal(record)
+        second = loaded_encodings(*self.reopen())
+        third = loaded_encodings(*self.reopen())
+        self.assertEqual(set(first), set(self.encodings))
+        for loaded in (second, third):
+            self.assertEqual(set(loaded), set(first))
+            for name in first:
+                np.testing.assert_array_equal(loaded[name], first[name])
+        np.testing.assert_allclose(second["A1_Test.jpg"], replaced)
+
+    def test_truncated_last_journal_line_is_ignored(self):
+        added = make_encoding(self.rng)
+        self.store.append_journal({"op": "add", "entry": make_entry("B1_Test.jpg"), "encoding": added.tolist()})
+        partial = json.dumps({"op": "remove", "files": ["A1_Test.jpg"]})
+        with open(self.store.journal_path, 'a', encoding='utf-8') as f:
+            f.write(partial[:len(partial) // 2])
+
+        store = FaceEncodingStore(self.folder, {"model": "hog"})
+        loaded = loaded_encodings(*store.load())
+        self.assertEqual(store.journal_length, 1)
+        self.assertIn("A1_Test.jpg", loaded)
+        np.testing.assert_allclose(loaded["B1_Test.jpg"], added)
+
+    def test_save_compacts_journal(self):
+        self.store.append_journal({"op": "remove", "files": ["A1_Test.jpg"]})
+        entries, matrix = self.reopen()
+        self.store.save(entries, matrix)
+
+        self.assertFalse(os.path.exists(self.store.journal_path))
+        matrices = [name for name in os.listdir(self.folder) if name.startswith("encodings-")]
+        self.assertEqual(len(matrices), 1)
+        self.assertEqual(set(loaded_encodings(*self.reopen())), {"A2_Test.jpg", "A3_Test.jpg"})
+
+    def test_changed_encoder_settings_discard_cache(self):
+        self.store.append_journal({"op": "remove", "files": ["A1_Test.jpg"]})
+        entries, matrix = FaceEncodingStore(self.folder, {"model": "cnn"}).load()
+        self.assertEqual(entries, [])
+        self.assertEqual(matrix.shape, (0, ENCODING_SIZE))
+
+
+class FaceGalleryConsistencyTest(unittest.TestCase):
+    def assert_consistent(self, gallery, expected):
+        """expected: {file: (employee_id, encoding, quality)}"""
+        size = len(gallery)
+        self.assertEqual(size, len(expected))
+        for values in (gallery.employee_ids, gallery.employee_names, gallery.qualities):
+            self.assertEqual(len(values), size)
+        self.assertEqual(set(gallery.files), set(expected))
+
+        employee_rows = {}
+        for row, filename in enumerate(gallery.files):
+            employee_id, encoding, quality = expected[filename]
+            self.assertEqual(gallery.file_rows[filename], row)
+            self.assertEqual(gallery.employee_ids[row], employee_id)
+            self.assertAlmostEqual(gallery.qualities[row], quality, places=6)
+            np.testing.assert_array_equal(gallery.matrix[row], encoding)
+            self.assertAlmostEqual(float(gallery.sq_norms[row]), float(np.dot(encoding, encoding)), places=4)
+            employee_rows.setdefault(employee_id, set()).add(row)
+        self.assertEqual(len(gallery.file_rows), size)
+        self.assertEqual(gallery.employee_rows, employee_rows)
+
+        if gallery.templates is not None:
+            self.assertEqual(set(gallery.templates.files), set(employee_rows))
+            for employee_id, rows in employee_rows.items():
+                rows = sorted(rows)
+                weights = np.maximum([gallery.qualities[row] for row in rows], 0.05)
+                centroid = weights @ gallery.matrix[rows] / weights.sum()
+                np.testing.assert_allclose(gallery.templates.matrix[gallery.templates.file_rows[employee_id]],
+                                           centroid, rtol=1e-5, atol=1e-6)
+
+        index = gallery.index
+        if index is not None:
+            self.assertEqual(set(index.row_lists), set(range(size)))
+            self.assertEqual(sum(len(rows) for rows in index.lists), size)
+            for row, list_id in index.row_lists.items():
+                self.assertIn(row, index.lists[list_id])
+                nearest = IVFIndex._nearest_centroids(gallery.matrix[row], index.centroids, 1)[0, 0]
+                self.assertEqual(list_id, nearest)
+
+    def run_random_operations(self, gallery, seed, expected=None, steps=400):
+        rng = np.random.default_rng(seed)
+        picker = random.Random(seed)
+        expected = {} if expected is None else expected
+        for step in range(steps):
+            if expected and picker.random() < 0.4:
+                filename = picker.choice(sorted(expected))
+                self.assertTrue(gallery.remove(filename))
+                del expected[filename]
+            else:
+                # Thỉnh thoảng ghi đè một file đã có (đăng ký lại ảnh chính)
+                if expected and picker.random() < 0.1:
+                    filename = picker.choice(sorted(expected))
+                    employee_id = expected[filename][0]
+                else:
+                    employee_id = f"E{picker.randrange(12)}"
+                    filename = f"{employee_id}_Test.{step}.jpg"
+                encoding = make_encoding(rng)
+                quality = picker.random()
+                gallery.add(filename, employee_id, "Test", encoding, quality)
+                expected[filename] = (employee_id, encoding, quality)
+            self.assert_consistent(gallery, expected)
+        self.assertFalse(gallery.remove("missing.jpg"))
+        return expected
+
+    def test_random_add_remove_keeps_rows_consistent(self):
+        self.run_random_operations(FaceGallery(capacity=4), seed=1)
+
+    def test_random_add_remove_keeps_templates_consistent(self):
+        self.run_random_operations(FaceGallery(capacity=4, templates=True), seed=2)
+
+    def test_random_add_remove_keeps_ivf_index_consistent(self):
+        rng = np.random.default_rng(3)
+        gallery = FaceGallery(capacity=4)
+        expected = {}
+        for i in range(50):
+            encoding = make_encoding(rng)
+            gallery.add(f"S{i}_Seed.jpg", f"S{i}", "Seed", encoding)
+            expected[f"S{i}_Seed.jpg"] = (f"S{i}", encoding, 1.0)
+        index = IVFIndex(nlist=6, nprobe=6)
+        index.train(gallery.encodings)
+        gallery.attach_index(index)
+        self.assert_consistent(gallery, expected)
+
+        expected = self.run_random_operations(gallery, seed=3, expected=expected)
+        for filename in sorted(expected):
+            gallery.remove(filename)
+        self.assert_consistent(gallery, {})
+
+    def test_ivf_match_with_all_lists_probed_equals_linear_scan(self):
+        rng = np.random.default_rng(4)
+        linear = FaceGallery()
+        indexed = FaceGallery()
+        for i in range(200):
+            encoding = make_encoding(rng)
+            linear.add(f"E{i}_Test.jpg", f"E{i}", "Test", encoding)
+            indexed.add(f"E{i}_Test.jpg", f"E{i}", "Test", encoding)
+        index = IVFIndex(nlist=8, nprobe=8)
+        index.train(indexed.encodings)
+        indexed.attach_index(index)
+        for i in range(0, 200, 3):
+            linear.remove(f"E{i}_Test.jpg")
+            indexed.remove(f"E{i}_Test.jpg")
+
+        queries = np.stack([make_encoding(rng) for _ in range(20)])
+        linear_rows, linear_distances = linear.match(queries, k=5)
+        indexed_rows, indexed_distances = indexed.match(queries, k=5)
+        np.testing.assert_array_equal(indexed_rows, linear_rows)
+        np.testing.assert_allclose(indexed_distances, linear_distances, rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()